@@ -11,7 +11,6 @@ from flask_babel import Babel, lazy_gettext as _l
 from config import Config
 from elasticsearch import Elasticsearch
 from redis import Redis
-import rq
 
 def get_locale():
     return request.accept_languages.best_match(current_app.config['LANGUAGES'])
@@ -40,9 +39,40 @@ def create_app(config_class=Config):
 
     app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
         if app.config['ELASTICSEARCH_URL'] else None
+    from app.search import create_backend
+    app.search_backend = create_backend(app)
+    from app.search.cache import SearchCache
+    app.search_cache = SearchCache(app)
 
     app.redis = Redis.from_url(app.config['REDIS_URL'])
-    app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
+    from app.queues import create_queues
+    app.task_queues = create_queues(app)
+    app.task_queue = app.task_queues['default']
+
+    from app.artifacts import ArtifactStore
+    app.artifacts = ArtifactStore(app.config['ARTIFACT_DIR'],
+                                  app.config['ARTIFACT_RETENTION'])
+
+    from app.activity import LastSeenTracker
+    app.last_seen_tracker = LastSeenTracker(app)
+
+    from app.cache import TTLCache
+    app.user_cache = TTLCache(app.config['USER_CACHE_SIZE'],
+                              app.config['USER_CACHE_TTL'])
+
+    from app.revocation import RevocationListener, token_cache_handler, \
+        user_cache_handler, jti_revocation_handler
+    app.token_cache = TTLCache(app.config['TOKEN_CACHE_SIZE'],
+                               app.config['TOKEN_CACHE_TTL'])
+    app.revocation_listener = RevocationListener(app)
+    app.revocation_listener.handlers.append(
+        token_cache_handler(app.token_cache))
+    app.revocation_listener.handlers.append(
+        user_cache_handler(app.user_cache))
+    app.revoked_tokens = TTLCache(app.config['API_TOKEN_REVOCATION_SIZE'],
+                                  app.config['API_TOKEN_EXPIRES_IN'])
+    app.revocation_listener.handlers.append(
+        jti_revocation_handler(app, app.revoked_tokens))
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
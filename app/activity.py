@@ -0,0 +1,70 @@
+import atexit
+from datetime import datetime, timezone, timedelta
+import threading
+import time
+import sqlalchemy as sa
+from flask import current_app
+from app import db
+
+
+class LastSeenTracker:
+    """Gom các lần cập nhật User.last_seen trong bộ nhớ rồi ghi theo lô.
+
+    Mỗi user chỉ được ghi nhận lại khi last_seen cũ hơn LAST_SEEN_GRANULARITY
+    giây, và các giá trị chờ được ghi bằng 1 lệnh UPDATE cho nhiều user mỗi
+    LAST_SEEN_FLUSH_INTERVAL giây, nên request đọc không còn phải commit.
+    Các giá trị còn chờ được ghi nốt khi process kết thúc."""
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_flush = time.time()
+        if app is not None:
+            atexit.register(self._flush_at_exit, app)
+
+    def _flush_at_exit(self, app):
+        with app.app_context():
+            self.flush(force=True)
+
+    def record(self, user):
+        now = datetime.now(timezone.utc)
+        granularity = timedelta(
+            seconds=current_app.config['LAST_SEEN_GRANULARITY'])
+        if user.last_seen is not None and \
+                now - user.last_seen.replace(tzinfo=timezone.utc) < granularity:
+            return
+        with self._lock:
+            self._pending[user.id] = now
+
+    def flush(self, force=False):
+        """Ghi các giá trị đang chờ xuống database, trả về số user được ghi.
+        Nếu lỗi thì các giá trị được giữ lại để ghi ở lần sau."""
+        with self._lock:
+            if not force and time.time() - self._last_flush < \
+                    current_app.config['LAST_SEEN_FLUSH_INTERVAL']:
+                return 0
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+        if pending:
+            # user đã bị xoá thì UPDATE không khớp dòng nào, bỏ qua
+            from app.models import User
+            table = User.__table__
+            try:
+                db.session.execute(
+                    table.update().where(table.c.id == sa.bindparam('user_id'))
+                    .values(last_seen=sa.bindparam('seen')),
+                    [{'user_id': id, 'seen': last_seen}
+                     for id, last_seen in pending.items()])
+                db.session.commit()
+            except sa.exc.SQLAlchemyError:
+                # vd. database đang bị khoá: không làm hỏng request đang chạy
+                db.session.rollback()
+                current_app.logger.error(
+                    'Could not save last_seen of %d users', len(pending),
+                    exc_info=True)
+                with self._lock:
+                    # giá trị mới hơn ghi nhận trong lúc đó được giữ nguyên
+                    for id, last_seen in pending.items():
+                        self._pending.setdefault(id, last_seen)
+                return 0
+        return len(pending)
@@ -22,7 +22,16 @@ def basic_auth_error(status):
 
 @token_auth.verify_token
 def verify_token(token):
-    return User.check_token(token) if token else None
+    if not token:
+        return None
+    # token JWT có dạng header.payload.signature, token cũ là chuỗi hex
+    if is_signed_token(token):
+        return User.check_signed_token(token)
+    return User.check_token(token)
+
+
+def is_signed_token(token):
+    return token.count('.') == 2
 
 
 @token_auth.error_handler
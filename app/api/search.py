@@ -0,0 +1,29 @@
+from flask import request, url_for
+from app.models import Post
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request
+
+
+@bp.route('/search', methods=['GET'])
+@token_auth.login_required
+def search_posts():
+    q = request.args.get('q', '').strip()
+    if not q:
+        return bad_request('must include q')
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    cursor = request.args.get('cursor')
+    posts, next_cursor = Post.search_cursor(q, per_page, cursor)
+    return {
+        'items': [post.to_dict() for post in posts],
+        '_meta': {
+            'per_page': per_page,
+            'next_cursor': next_cursor
+        },
+        '_links': {
+            'self': url_for('api.search_posts', q=q, per_page=per_page,
+                            cursor=cursor),
+            'next': url_for('api.search_posts', q=q, per_page=per_page,
+                            cursor=next_cursor) if next_cursor else None
+        }
+    }
@@ -1,10 +1,13 @@
+from flask import current_app
 from app import db
 from app.api import bp
-from app.api.auth import basic_auth, token_auth
+from app.api.auth import basic_auth, token_auth, is_signed_token
 
 @bp.route('/tokens', methods=['POST'])
 @basic_auth.login_required
 def get_token():
+    if current_app.config['API_TOKEN_MODE'] == 'jwt':
+        return {'token': basic_auth.current_user().get_signed_token()}
     token = basic_auth.current_user().get_token()
     db.session.commit()
     return {'token': token}
@@ -12,6 +15,10 @@ def get_token():
 @bp.route('/tokens', methods=['DELETE'])
 @token_auth.login_required
 def revoke_token():
+    token = token_auth.get_auth().token
+    if is_signed_token(token):
+        token_auth.current_user().revoke_signed_token(token)
+        return '', 204
     token_auth.current_user().revoke_token()
     db.session.commit()
-    return '', 204
\ No newline at end of file
+    return '', 204
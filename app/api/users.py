@@ -8,6 +8,18 @@ from app.api.errors import bad_request
 from langdetect import detect
 
 
+# ?page= dùng phân trang OFFSET cũ, mặc định phân trang bằng con trỏ
+def _collection(model, query, endpoint, **kwargs):
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    if 'page' in request.args:
+        page = request.args.get('page', 1, type=int)
+        return model.to_collection_dict(query, page, per_page, endpoint,
+                                        **kwargs)
+    return model.to_cursor_collection_dict(
+        query, per_page, endpoint, before=request.args.get('before'),
+        after=request.args.get('after'), **kwargs)
+
+
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
@@ -17,30 +29,23 @@ def get_user(id):
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
 def get_users():
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return User.to_collection_dict(sa.select(User), page, per_page,
-                                   'api.get_users')
+    return _collection(User, sa.select(User), 'api.get_users')
 
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
 @token_auth.login_required
 def get_followers(id):
     user = db.get_or_404(User, id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return User.to_collection_dict(user.followers.select(), page, per_page,
-                                   'api.get_followers', id=id)
+    return _collection(User, user.followers.select(), 'api.get_followers',
+                       id=id)
 
 
 @bp.route('/users/<int:id>/following', methods=['GET'])
 @token_auth.login_required
 def get_following(id):
     user = db.get_or_404(User, id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return User.to_collection_dict(user.following.select(), page, per_page,
-                                   'api.get_following', id=id)
+    return _collection(User, user.following.select(), 'api.get_following',
+                       id=id)
 
 
 @bp.route('/users', methods=['POST'])
@@ -84,17 +89,12 @@ def update_user(id):
 @bp.route('/users/<int:id>/post', methods=['GET'])
 @token_auth.login_required
 def get_post(id):
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return Post.to_collection_dict(sa.select(Post).where(Post.user_id==id), page, per_page,
-                                   'api.get_post', id=id)
+    return _collection(Post, sa.select(Post).where(Post.user_id == id),
+                       'api.get_post', id=id)
 @bp.route('/users/<int:id>/posts', methods=['GET'])
 @token_auth.login_required
 def get_all_posts(id):
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return Post.to_collection_dict(sa.select(Post), page, per_page,
-                                   'api.get_all_posts', id=id)
+    return _collection(Post, sa.select(Post), 'api.get_all_posts', id=id)
 
 @bp.route('/users/<int:id>', methods=['POST'])
 def create_post(id):
@@ -0,0 +1,66 @@
+import os
+import shutil
+import time
+
+# Kho file do task nền tạo ra (vd. file xuất bài post), thay cho đính kèm
+# email. Mỗi artifact là 1 thư mục <root>/<owner_id>/<key>/ chứa 1 file; file
+# .checkpoint bên cạnh nghĩa là task vẫn đang ghi. Artifact bị xoá sau
+# `retention` giây kể từ lần ghi cuối.
+
+
+class ArtifactStore:
+    def __init__(self, root, retention):
+        self.root = root
+        self.retention = retention
+
+    def _dir(self, owner_id, key):
+        key = str(key)
+        if not key or key != os.path.basename(key) or key.startswith('.'):
+            raise ValueError(f'Invalid artifact key: {key}')
+        return os.path.join(self.root, str(owner_id), key)
+
+    def path(self, owner_id, key, filename):
+        """Đường dẫn để task ghi artifact, tạo thư mục nếu chưa có."""
+        directory = self._dir(owner_id, key)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, filename)
+
+    def get(self, owner_id, key):
+        """Đường dẫn của artifact đã ghi xong và chưa hết hạn, None nếu
+        không có."""
+        try:
+            directory = self._dir(owner_id, key)
+            names = os.listdir(directory)
+        except (ValueError, OSError):
+            return None
+        if len(names) != 1 or self.expires_at(directory) < time.time():
+            return None
+        return os.path.join(directory, names[0])
+
+    def expires_at(self, path):
+        return os.path.getmtime(path) + self.retention
+
+    def cleanup(self, now=None):
+        """Xoá các artifact hết hạn, trả về số artifact đã xoá."""
+        now = time.time() if now is None else now
+        removed = 0
+        try:
+            owners = os.listdir(self.root)
+        except FileNotFoundError:
+            return 0
+        for owner in owners:
+            owner_dir = os.path.join(self.root, owner)
+            for key in os.listdir(owner_dir):
+                directory = os.path.join(owner_dir, key)
+                try:
+                    if self.expires_at(directory) < now:
+                        shutil.rmtree(directory)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+            try:
+                os.rmdir(owner_dir)
+            except OSError:
+                # vẫn còn artifact
+                pass
+        return removed
@@ -1,6 +1,12 @@
+from datetime import datetime
 import os
-from flask import Blueprint
+import time
+from flask import Blueprint, current_app
 import click
+import redis
+import sqlalchemy as sa
+from app import db, indexing, queues
+from app.models import User, Post, Message, followers
 
 bp = Blueprint('cli', __name__, cli_group=None)
 
@@ -37,4 +43,240 @@ def update():
 def compile():
     """Compile all languages."""
     if os.system('pybabel compile -d app/translations'):
-        raise RuntimeError('compile command failed')
\ No newline at end of file
+        raise RuntimeError('compile command failed')
+
+
+@bp.cli.group()
+def counters():
+    """User counter maintenance commands."""
+    pass
+
+
+def _user_batches(batch_size):
+    last_id = 0
+    while True:
+        ids = db.session.scalars(sa.select(User.id).where(
+            User.id > last_id).order_by(User.id).limit(batch_size)).all()
+        if not ids:
+            return
+        yield ids
+        last_id = ids[-1]
+
+
+def _count_by(column, ids):
+    query = sa.select(column, sa.func.count()).where(
+        column.in_(ids)).group_by(column)
+    return dict(db.session.execute(query).all())
+
+
+def _count_unread(ids):
+    query = sa.select(Message.recipient_id, sa.func.count()).join(
+        User, User.id == Message.recipient_id).where(
+            Message.recipient_id.in_(ids),
+            Message.timestamp > sa.func.coalesce(
+                User.last_message_read_time, datetime(1900, 1, 1))).group_by(
+                    Message.recipient_id)
+    return dict(db.session.execute(query).all())
+
+
+def _expected_counters(ids):
+    posts = _count_by(Post.user_id, ids)
+    num_followers = _count_by(followers.c.followed_id, ids)
+    num_following = _count_by(followers.c.follower_id, ids)
+    num_unread = _count_unread(ids)
+    return {id: {'num_posts': posts.get(id, 0),
+                 'num_followers': num_followers.get(id, 0),
+                 'num_following': num_following.get(id, 0),
+                 'num_unread_messages': num_unread.get(id, 0)}
+            for id in ids}
+
+
+def _wrong_counters(ids):
+    expected = _expected_counters(ids)
+    query = sa.select(User.id, User.num_posts, User.num_followers,
+                      User.num_following, User.num_unread_messages).where(
+                          User.id.in_(ids))
+    wrong = []
+    for id, num_posts, num_followers, num_following, num_unread in \
+            db.session.execute(query):
+        actual = {'num_posts': num_posts, 'num_followers': num_followers,
+                  'num_following': num_following,
+                  'num_unread_messages': num_unread}
+        if actual != expected[id]:
+            wrong.append((id, actual, expected[id]))
+    return wrong
+
+
+@counters.command()
+@click.option('--batch-size', default=1000, help='Users per batch.')
+def check(batch_size):
+    """Report users whose counters do not match the database."""
+    total = 0
+    for ids in _user_batches(batch_size):
+        for id, actual, expected in _wrong_counters(ids):
+            click.echo(f'user {id}: {actual} != {expected}')
+            total += 1
+    click.echo(f'{total} users with wrong counters')
+    if total:
+        raise SystemExit(1)
+
+
+@counters.command()
+@click.option('--batch-size', default=1000, help='Users per batch.')
+def repair(batch_size):
+    """Recompute user counters in batches."""
+    total = 0
+    for ids in _user_batches(batch_size):
+        wrong = _wrong_counters(ids)
+        if wrong:
+            db.session.execute(sa.update(User), [
+                {'id': id, **expected} for id, actual, expected in wrong])
+        db.session.commit()
+        total += len(wrong)
+    click.echo(f'{total} users repaired')
+
+
+@bp.cli.group()
+def search():
+    """Search index commands."""
+    pass
+
+
+@search.command()
+@click.option('--batch-size', type=int, help='Documents per bulk request.')
+@click.option('--interval', default=1.0, help='Seconds to wait when idle.')
+@click.option('--once', is_flag=True, help='Drain the queue and exit.')
+def worker(batch_size, interval, once):
+    """Send queued index changes to Elasticsearch."""
+    if not current_app.elasticsearch:
+        raise click.ClickException('ELASTICSEARCH_URL is not configured')
+    batch_size = batch_size or current_app.config['SEARCH_QUEUE_BATCH_SIZE']
+    while True:
+        try:
+            sent, failed = indexing.process_batch(batch_size)
+        except redis.exceptions.RedisError as e:
+            click.echo(f'redis error: {e}', err=True)
+            sent = failed = 0
+        if sent:
+            click.echo(f'{sent} documents sent, {failed} failed')
+        elif once:
+            return
+        else:
+            time.sleep(interval)
+
+
+@search.command()
+@click.argument('models', nargs=-1)
+@click.option('--chunk-size', default=1000, help='Rows per bulk request.')
+@click.option('--workers', default=4, help='Parallel bulk requests.')
+@click.option('--swap/--in-place', default=True,
+              help='Build a new index and swap the alias when done.')
+def reindex(models, chunk_size, workers, swap):
+    """Rebuild the search index of MODELS (default: all)."""
+    searchable = indexing.searchable_models()
+    for name in models or sorted(searchable):
+        if name not in searchable:
+            raise click.ClickException(f'{name} is not searchable')
+        start = time.monotonic()
+        last = 0
+
+        def progress(done, total):
+            nonlocal last
+            now = time.monotonic()
+            if now - last >= 1 or done >= total:
+                last = now
+                rate = done / max(now - start, 1e-6)
+                click.echo(f'{name}: {done}/{total} ({rate:.0f} docs/s)')
+
+        done, failed = searchable[name].reindex(chunk_size=chunk_size,
+                                                workers=workers, swap=swap,
+                                                progress=progress)
+        elapsed = time.monotonic() - start
+        click.echo(f'{name}: {done} documents in {elapsed:.1f}s, '
+                   f'{failed} failed')
+
+
+@search.command()
+@click.option('--docs', default=20000, help='Synthetic documents.')
+@click.option('--queries', default=500, help='Queries to run.')
+@click.option('--seed', default=1, help='Random seed.')
+def benchmark(docs, queries, seed):
+    """Compare the memory backend with Elasticsearch."""
+    from app.search import benchmark
+    if not current_app.elasticsearch:
+        click.echo('ELASTICSEARCH_URL is not configured, '
+                   'only the memory backend is measured')
+    for result in benchmark.run(docs, queries, current_app.elasticsearch,
+                                seed):
+        click.echo(f"{result['backend']}: indexed {docs} docs in "
+                   f"{result['index_time']:.2f}s, "
+                   f"p50 {result['p50']:.2f}ms, p95 {result['p95']:.2f}ms, "
+                   f"{result['qps']:.0f} queries/s")
+
+
+@search.command('cache-stats')
+def cache_stats():
+    """Show search result cache hits and misses."""
+    stats = current_app.search_cache.stats()
+    click.echo(f"{stats['hits']} hits, {stats['misses']} misses, "
+               f"hit rate {stats['hit_rate']:.1%}")
+
+
+@search.command('requeue-dead')
+def requeue_dead():
+    """Move failed index changes back to the queue."""
+    click.echo(f'{indexing.requeue_dead()} changes requeued')
+
+
+@bp.cli.group()
+def artifacts():
+    """Background task artifact commands."""
+    pass
+
+
+@artifacts.command()
+def cleanup():
+    """Delete expired artifacts."""
+    click.echo(f'{current_app.artifacts.cleanup()} artifacts removed')
+
+
+@artifacts.command()
+@click.option('--interval', default=3600, help='Seconds between cleanups.')
+def schedule(interval):
+    """Run the cleanup periodically on the task workers.
+
+    The job reschedules itself, running this again does nothing while it is
+    scheduled; workers must be started with --with-scheduler."""
+    if queues.scheduled_job_id('cleanup_artifacts') is not None:
+        click.echo('artifact cleanup is already scheduled')
+        return
+    queues.schedule_periodic('cleanup_artifacts', interval)
+    click.echo(f'artifact cleanup scheduled every {interval}s')
+
+
+@bp.cli.group()
+def tasks():
+    """Background task commands."""
+    pass
+
+
+@tasks.command('worker')
+@click.option('--pools', help='Worker processes per queue, e.g. '
+              'high=2,default=2,bulk=1 (default: TASK_WORKERS).')
+def tasks_worker(pools):
+    """Run task worker processes for every queue."""
+    pools = queues.parse_pools(pools or current_app.config['TASK_WORKERS'])
+    unknown = set(pools) - set(current_app.task_queues)
+    if unknown:
+        raise click.ClickException(
+            f'Unknown task queues: {", ".join(sorted(unknown))}')
+    queues.run_workers(current_app.config['REDIS_URL'], pools, click.echo)
+
+
+@tasks.command('stats')
+def tasks_stats():
+    """Show queued/running jobs and latency of each task queue."""
+    for s in queues.stats(current_app.task_queues):
+        click.echo(f"{s['queue']}: {s['queued']} queued, {s['started']} "
+                   f"running, {s['failed']} failed, {s['workers']} workers, "
+                   f"oldest job waiting {s['latency']:.1f}s")
@@ -0,0 +1,108 @@
+import gzip
+import json
+import os
+import sqlalchemy as sa
+from app import db
+from app.models import Post
+from app.pagination import encode_cursor, decode_cursor, _seek
+
+# Xuất bài post của user ra file nén trên đĩa: đọc từng lô theo (timestamp,
+# id) nên bộ nhớ không phụ thuộc số bài, mỗi lô được ghi thành 1 gzip member
+# nối tiếp nhau (gzip/zcat đọc liền như 1 file). Sau mỗi lô, vị trí trong
+# file và con trỏ của bài cuối được ghi vào file checkpoint bên cạnh; worker
+# chạy lại cùng job sẽ cắt bỏ phần ghi dở và tiếp tục từ đó.
+
+FORMATS = {'ndjson': 'application/x-ndjson', 'json': 'application/json'}
+
+
+def export_filename(fmt):
+    return f'posts.{fmt}.gz'
+
+
+def _checkpoint_path(path):
+    return path + '.checkpoint'
+
+
+def _load_checkpoint(path):
+    try:
+        with open(_checkpoint_path(path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_checkpoint(path, checkpoint):
+    # ghi file tạm rồi đổi tên để checkpoint không bao giờ bị ghi dở
+    tmp = _checkpoint_path(path) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, _checkpoint_path(path))
+
+
+def _write_member(f, text):
+    f.write(gzip.compress(text.encode('utf-8'), compresslevel=6))
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _serialize(row):
+    return json.dumps({'body': row.body,
+                       'timestamp': row.timestamp.isoformat() + 'Z'},
+                      ensure_ascii=False)
+
+
+def export_posts(user, path, fmt='ndjson', chunk_size=1000, progress=None):
+    """Ghi toàn bộ bài post của `user` vào `path` (gzip), tiếp tục từ
+    checkpoint nếu có. `progress(done, total)` được gọi sau mỗi lô. Trả về
+    số bài đã xuất."""
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown export format: {fmt}')
+    total = db.session.scalar(sa.select(sa.func.count()).select_from(
+        user.posts.select().subquery()))
+    checkpoint = _load_checkpoint(path)
+    if checkpoint is None or checkpoint.get('format') != fmt or \
+            not os.path.exists(path):
+        checkpoint = {'format': fmt, 'offset': 0, 'cursor': None, 'count': 0}
+    columns = Post.cursor_columns()
+    after = decode_cursor(checkpoint['cursor'], columns)
+    done = checkpoint['count']
+
+    with open(path, 'r+b' if checkpoint['offset'] else 'wb') as f:
+        # bỏ phần được ghi sau checkpoint cuối cùng
+        f.truncate(checkpoint['offset'])
+        f.seek(checkpoint['offset'])
+        if fmt == 'json' and not checkpoint['offset']:
+            _write_member(f, '{"posts": [')
+        while True:
+            query = sa.select(Post.id, Post.body, Post.timestamp).where(
+                Post.user_id == user.id)
+            if after is not None:
+                query = query.where(_seek(columns, after, older=False))
+            rows = db.session.execute(query.order_by(
+                Post.timestamp.asc(), Post.id.asc()).limit(chunk_size)).all()
+            if not rows:
+                break
+            lines = [_serialize(row) for row in rows]
+            if fmt == 'json':
+                text = (',' if done else '') + ','.join(lines)
+            else:
+                text = '\n'.join(lines) + '\n'
+            _write_member(f, text)
+            done += len(rows)
+            after = [rows[-1].timestamp, rows[-1].id]
+            _save_checkpoint(path, {'format': fmt, 'offset': f.tell(),
+                                    'cursor': encode_cursor(after),
+                                    'count': done})
+            if progress:
+                progress(done, max(total, done))
+            if len(rows) < chunk_size:
+                break
+        if fmt == 'json':
+            _write_member(f, ']}')
+
+    if os.path.exists(_checkpoint_path(path)):
+        os.remove(_checkpoint_path(path))
+    return done
+
@@ -0,0 +1,293 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import json
+import time
+import redis
+import sqlalchemy as sa
+from elasticsearch import helpers
+from flask import current_app
+from app import db
+from app.search import cache
+
+# Việc cập nhật Elasticsearch không làm trong request nữa: sau khi commit,
+# các cặp (index, id, op) được đẩy vào 1 list trong Redis, worker
+# (`flask search worker`) lấy ra theo lô và gửi bằng bulk API. Lỗi được thử
+# lại sau một khoảng tăng dần, quá số lần cho phép thì chuyển sang dead-letter.
+
+QUEUE_KEY = 'search-queue'
+RETRY_KEY = 'search-queue-retry'
+DEAD_KEY = 'search-queue-dead'
+# các index đang được dựng lại; thay đổi của chúng được ghi thêm vào
+# search-reindex-log:<index> để gửi lại vào index mới sau khi đổi alias
+REINDEXING_KEY = 'search-reindexing'
+
+_ENQUEUE_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    redis.call('rpush', KEYS[1], ARGV[i + 1])
+    if redis.call('sismember', KEYS[2], ARGV[i]) == 1 then
+        redis.call('rpush', 'search-reindex-log:' .. ARGV[i], ARGV[i + 1])
+    end
+end
+"""
+
+# chuyển log vào hàng đợi và ngừng ghi log trong cùng 1 thao tác, để không
+# thay đổi nào bị bỏ sót giữa 2 bước
+_REPLAY_SCRIPT = """
+redis.call('srem', KEYS[1], ARGV[1])
+local count = redis.call('llen', KEYS[2])
+if ARGV[2] == '1' then
+    for start = 0, count - 1, 1000 do
+        local items = redis.call('lrange', KEYS[2], start, start + 999)
+        redis.call('rpush', KEYS[3], unpack(items))
+    end
+end
+redis.call('del', KEYS[2])
+return count
+"""
+
+
+def _log_key(index):
+    return f'search-reindex-log:{index}'
+
+
+def enqueue(changes):
+    """Đẩy các thay đổi (index, id, op) vào hàng đợi, op là index/delete."""
+    if not changes or not current_app.elasticsearch:
+        return
+    args = []
+    for index, id, op in changes:
+        args.extend([index, json.dumps({'index': index, 'id': id, 'op': op})])
+    script = current_app.redis.register_script(_ENQUEUE_SCRIPT)
+    try:
+        script(keys=[QUEUE_KEY, REINDEXING_KEY], args=args)
+    except redis.exceptions.RedisError:
+        # không để lỗi index làm hỏng request, chạy reindex để sửa
+        current_app.logger.warning('Could not queue %d search changes',
+                                   len(changes))
+
+
+def collapse(entries):
+    """Gộp các thay đổi của cùng 1 document, giữ thay đổi cuối cùng."""
+    latest = {}
+    for entry in entries:
+        key = (entry['index'], entry['id'])
+        latest.pop(key, None)
+        entry.setdefault('attempts', 0)
+        latest[key] = entry
+    return list(latest.values())
+
+
+def searchable_models():
+    from app.models import SearchableMixin
+    return {cls.__tablename__: cls for cls in SearchableMixin.__subclasses__()}
+
+
+def _actions(entries):
+    models = searchable_models()
+    objects = {}
+    for index in {e['index'] for e in entries if e['op'] == 'index'}:
+        cls = models[index]
+        ids = [e['id'] for e in entries
+               if e['index'] == index and e['op'] == 'index']
+        for obj in db.session.scalars(sa.select(cls).where(cls.id.in_(ids))):
+            objects[(index, obj.id)] = obj
+    actions = []
+    for entry in entries:
+        obj = objects.get((entry['index'], entry['id']))
+        if entry['op'] == 'index' and obj is not None:
+            actions.append({
+                '_op_type': 'index', '_index': entry['index'],
+                '_id': entry['id'],
+                '_source': {'id': entry['id'],
+                            **{field: getattr(obj, field)
+                               for field in obj.__searchable__}}})
+        else:
+            # document đã bị xoá khỏi database trước khi worker xử lý
+            actions.append({'_op_type': 'delete', '_index': entry['index'],
+                            '_id': entry['id']})
+    return actions
+
+
+def _pop_batch(batch_size):
+    pipe = current_app.redis.pipeline()
+    pipe.lrange(QUEUE_KEY, 0, batch_size - 1)
+    pipe.ltrim(QUEUE_KEY, batch_size, -1)
+    return [json.loads(item) for item in pipe.execute()[0]]
+
+
+def _move_due_retries():
+    now = time.time()
+    due = current_app.redis.zrangebyscore(RETRY_KEY, '-inf', now)
+    if due:
+        pipe = current_app.redis.pipeline()
+        pipe.zremrangebyscore(RETRY_KEY, '-inf', now)
+        pipe.rpush(QUEUE_KEY, *due)
+        pipe.execute()
+
+
+def _retry(failed):
+    max_attempts = current_app.config['SEARCH_QUEUE_MAX_ATTEMPTS']
+    delay = current_app.config['SEARCH_QUEUE_RETRY_DELAY']
+    pipe = current_app.redis.pipeline()
+    for entry, error in failed:
+        entry['attempts'] += 1
+        entry['error'] = str(error)[:500]
+        if entry['attempts'] >= max_attempts:
+            pipe.rpush(DEAD_KEY, json.dumps(entry))
+        else:
+            retry_at = time.time() + delay * 2 ** (entry['attempts'] - 1)
+            pipe.zadd(RETRY_KEY, {json.dumps(entry): retry_at})
+    pipe.execute()
+
+
+def process_batch(batch_size):
+    """Xử lý 1 lô thay đổi, trả về (số document đã gửi, số lỗi)."""
+    _move_due_retries()
+    entries = collapse(_pop_batch(batch_size))
+    if not entries:
+        return 0, 0
+    try:
+        actions = _actions(entries)
+    except Exception as e:
+        # vd. database không truy cập được: các thay đổi đã lấy khỏi hàng
+        # đợi được thử lại sau, không bị mất
+        current_app.logger.error('Could not load %d search changes',
+                                 len(entries), exc_info=True)
+        _retry([(entry, e) for entry in entries])
+        return 0, len(entries)
+    finally:
+        db.session.rollback()
+    failed = []
+    results = helpers.streaming_bulk(
+        current_app.elasticsearch, actions, chunk_size=batch_size,
+        max_retries=0, raise_on_error=False, raise_on_exception=False)
+    for entry, (ok, item) in zip(entries, results):
+        op, result = next(iter(item.items()))
+        if not ok and not (op == 'delete' and result.get('status') == 404):
+            failed.append((entry, result.get('error', result)))
+    if failed:
+        _retry(failed)
+    cache.bump(entry['index'] for entry in entries)
+    return len(entries), len(failed)
+
+
+def requeue_dead():
+    """Đưa các thay đổi trong dead-letter trở lại hàng đợi."""
+    count = 0
+    while True:
+        item = current_app.redis.lpop(DEAD_KEY)
+        if item is None:
+            return count
+        entry = json.loads(item)
+        entry['attempts'] = 0
+        entry.pop('error', None)
+        current_app.redis.rpush(QUEUE_KEY, json.dumps(entry))
+        count += 1
+
+
+def _chunks(cls, chunk_size):
+    # đọc theo id tăng dần, chỉ lấy các cột cần index để không giữ object
+    columns = [getattr(cls, field) for field in cls.__searchable__]
+    last_id = 0
+    while True:
+        rows = db.session.execute(sa.select(cls.id, *columns).where(
+            cls.id > last_id).order_by(cls.id).limit(chunk_size)).all()
+        db.session.rollback()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def _send_chunk(client, index, fields, rows):
+    actions = [{'_index': index, '_id': row[0],
+                '_source': {'id': row[0], **dict(zip(fields, row[1:]))}}
+               for row in rows]
+    sent, errors = helpers.bulk(client, actions, raise_on_error=False,
+                                max_retries=3)
+    return sent, len(errors)
+
+
+def _swap_alias(client, alias, new_index):
+    actions = [{'add': {'index': new_index, 'alias': alias}}]
+    old = []
+    if client.indices.exists_alias(name=alias):
+        old = list(client.indices.get_alias(name=alias).keys())
+        actions = [{'remove': {'index': name, 'alias': alias}}
+                   for name in old] + actions
+    elif client.indices.exists(index=alias):
+        # index cũ không dùng alias, xoá nó trong cùng thao tác đổi alias
+        actions = [{'remove_index': {'index': alias}}] + actions
+    client.indices.update_aliases(actions=actions)
+    for name in old:
+        client.indices.delete(index=name)
+
+
+def _end_reindex(alias, replay):
+    script = current_app.redis.register_script(_REPLAY_SCRIPT)
+    return script(keys=[REINDEXING_KEY, _log_key(alias), QUEUE_KEY],
+                  args=[alias, '1' if replay else '0'])
+
+
+def reindex(cls, chunk_size=1000, workers=4, swap=True, progress=None):
+    """Đánh lại index toàn bộ bảng của `cls`, trả về (số document, số lỗi).
+
+    Dữ liệu được đọc theo từng khối cố định và gửi bằng bulk từ `workers`
+    thread. Với `swap`, dữ liệu được ghi vào 1 index mới rồi alias (tên bảng)
+    mới được chuyển sang index đó, nên tìm kiếm không bị gián đoạn. Các thay
+    đổi xảy ra trong lúc dựng index mới vẫn được worker ghi vào index cũ, và
+    được ghi lại để đưa vào hàng đợi lần nữa sau khi đổi alias.
+    `progress(done, total)` được gọi sau mỗi khối."""
+    client = current_app.elasticsearch
+    if not client:
+        return 0, 0
+    alias = cls.__tablename__
+    index = f'{alias}-{int(time.time())}' if swap else alias
+    if swap:
+        # ghi log từ trước khi đọc khối đầu tiên
+        current_app.redis.delete(_log_key(alias))
+        current_app.redis.sadd(REINDEXING_KEY, alias)
+        # không refresh trong lúc nạp dữ liệu, bật lại khi xong
+        client.indices.create(
+            index=index, settings={'refresh_interval': '-1'},
+            mappings={'properties': {'id': {'type': 'long'}}})
+    total = db.session.scalar(sa.select(sa.func.count()).select_from(cls))
+    done = failed = 0
+    pending = set()
+
+    def collect(futures):
+        nonlocal done, failed
+        for future in futures:
+            sent, errors = future.result()
+            done += sent + errors
+            failed += errors
+            if progress:
+                progress(done, total)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for rows in _chunks(cls, chunk_size):
+                pending.add(executor.submit(_send_chunk, client, index,
+                                            cls.__searchable__, rows))
+                if len(pending) >= workers * 2:
+                    # giới hạn số khối đang chờ để bộ nhớ không tăng theo bảng
+                    finished, pending = wait(pending,
+                                             return_when=FIRST_COMPLETED)
+                    collect(finished)
+            collect(pending)
+        if swap:
+            client.indices.put_settings(index=index,
+                                        settings={'refresh_interval': None})
+            client.indices.refresh(index=index)
+            _swap_alias(client, alias, index)
+            # các thay đổi trong lúc dựng index được gửi lại vào index mới
+            _end_reindex(alias, replay=True)
+        else:
+            client.indices.refresh(index=index)
+        cache.bump([alias])
+    except Exception:
+        if swap:
+            # index cũ vẫn được dùng và đã có các thay đổi
+            _end_reindex(alias, replay=False)
+            client.indices.delete(index=index, ignore_unavailable=True)
+        raise
+    return done, failed
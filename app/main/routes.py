@@ -1,23 +1,56 @@
-from datetime import datetime, timezone
-from flask import render_template, flash, redirect, url_for, request, g, current_app
+import os
+from flask import render_template, flash, redirect, url_for, request, g, \
+    current_app, make_response, Response, session, abort, send_file
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
+import redis
+from rq import Retry
 import sqlalchemy as sa
 from langdetect import detect, LangDetectException
-from app import db
+from app import db, export, notifications as notification_events
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm, MessageForm
 from app.models import User, Post, Message, Notification
+from app.pagination import paginate_cursor
 from app.main import bp
 
 
+# Mặc định phân trang bằng con trỏ (before/after), ?page= vẫn dùng OFFSET
+def _paginate(query, columns, endpoint, **kwargs):
+    per_page = current_app.config['POSTS_PER_PAGE']
+    if 'page' in request.args:
+        page = request.args.get('page', 1, type=int)
+        items = db.paginate(query, page=page, per_page=per_page,
+                            error_out=False)
+        next_url = url_for(endpoint, page=items.next_num, **kwargs) \
+            if items.has_next else None
+        prev_url = url_for(endpoint, page=items.prev_num, **kwargs) \
+            if items.has_prev else None
+        return items.items, next_url, prev_url
+    items = paginate_cursor(query, columns, per_page,
+                            before=request.args.get('before'),
+                            after=request.args.get('after'))
+    return _cursor_urls(items, endpoint, **kwargs)
+
+
+def _cursor_urls(items, endpoint, **kwargs):
+    next_url = url_for(endpoint, before=items.next_cursor, **kwargs) \
+        if items.has_next else None
+    prev_url = url_for(endpoint, after=items.prev_cursor, **kwargs) \
+        if items.has_prev else None
+    return items.items, next_url, prev_url
+
 
 @bp.before_app_request
 def before_request():
+    g.locale = str(get_locale())
+    if request.endpoint == 'main.notifications':
+        # để /notifications trả lời được mà không tải user
+        return
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        # last_seen được ghi theo lô, request đọc không cần commit
+        current_app.last_seen_tracker.record(current_user)
+        current_app.last_seen_tracker.flush()
         g.search_form = SearchForm()
-    g.locale = str(get_locale())
 
 
 @bp.route('/', methods=['GET', 'POST'])
@@ -36,33 +69,44 @@ def index():
         db.session.commit()
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    posts = db.paginate(current_user.following_posts(), page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for('main.index', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) \
-        if posts.has_prev else None
-    return render_template('index.html', title=_('Home'), form=form,
-                           posts=posts.items, next_url=next_url,
-                           prev_url=prev_url)
+    per_page = current_app.config['POSTS_PER_PAGE']
+    if 'page' in request.args:
+        page = request.args.get('page', 1, type=int)
+        result = current_user.timeline_posts(page, per_page)
+        if result is not None:
+            posts, total, source = result
+            next_url = url_for('main.index', page=page + 1) \
+                if total > page * per_page else None
+            prev_url = url_for('main.index', page=page - 1) \
+                if page > 1 else None
+        else:
+            posts, next_url, prev_url = _paginate(
+                current_user.following_posts(), Post.cursor_columns(),
+                'main.index')
+            source = 'sql'
+    else:
+        result = current_user.timeline_page(
+            per_page, before=request.args.get('before'),
+            after=request.args.get('after'))
+        posts, next_url, prev_url = _cursor_urls(result, 'main.index')
+        source = result.source
+    # cho biết trang chủ được lấy từ đâu: fanout, hybrid hoặc sql
+    current_app.logger.debug('Home timeline served by %s', source)
+    response = make_response(render_template(
+        'index.html', title=_('Home'), form=form, posts=posts,
+        next_url=next_url, prev_url=prev_url))
+    response.headers['X-Timeline-Source'] = source
+    return response
 
 
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
     query = sa.select(Post).order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for('main.explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
-        if posts.has_prev else None
+    posts, next_url, prev_url = _paginate(query, Post.cursor_columns(),
+                                          'main.explore')
     return render_template('index.html', title=_('Explore'),
-                           posts=posts.items, next_url=next_url,
+                           posts=posts, next_url=next_url,
                            prev_url=prev_url)
 
 
@@ -70,17 +114,11 @@ def explore():
 @login_required
 def user(username):
     user = db.first_or_404(sa.select(User).where(User.username == username))
-    page = request.args.get('page', 1, type=int)
     query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for('main.user', username=user.username,
-                       page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.user', username=user.username,
-                       page=posts.prev_num) if posts.has_prev else None
+    posts, next_url, prev_url = _paginate(query, Post.cursor_columns(),
+                                          'main.user', username=user.username)
     form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts.items,
+    return render_template('user.html', user=user, posts=posts,
                            next_url=next_url, prev_url=prev_url, form=form)
 
 
@@ -147,6 +185,19 @@ def unfollow(username):
 def search():
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
+    if 'page' not in request.args:
+        # search_after chỉ đi tiếp được, về đầu bằng link trang 1
+        cursor = request.args.get('cursor')
+        posts, next_cursor = Post.search_cursor(
+            g.search_form.q.data, current_app.config['POSTS_PER_PAGE'],
+            cursor)
+        next_url = url_for('main.search', q=g.search_form.q.data,
+                           cursor=next_cursor) if next_cursor else None
+        prev_url = url_for('main.search', q=g.search_form.q.data) \
+            if cursor else None
+        return render_template('search.html', title=_('Search'),
+                               posts=posts, next_url=next_url,
+                               prev_url=prev_url)
     page = request.args.get('page', 1, type=int)
     posts, total = Post.search(g.search_form.q.data, page,
                                current_app.config['POSTS_PER_PAGE'])
@@ -173,6 +224,9 @@ def send_message(recipient):
         msg = Message(author=current_user, recipient=user,
                       body=form.message.data)
         db.session.add(msg)
+        db.session.flush()
+        # bộ đếm tin chưa đọc được tăng trong database khi insert tin nhắn
+        db.session.refresh(user, ['num_unread_messages'])
         user.add_notification('unread_message_count',
                               user.unread_message_count())
         db.session.commit()
@@ -185,27 +239,18 @@ def send_message(recipient):
 @bp.route('/messages')
 @login_required
 def messages():
-    current_user.last_message_read_time = datetime.now(timezone.utc)
+    current_user.mark_messages_read()
     current_user.add_notification('unread_message_count', 0)
     db.session.commit()
-    page = request.args.get('page', 1, type=int)
     query = current_user.messages_received.select().order_by(
         Message.timestamp.desc())
-    messages = db.paginate(query, page=page,
-                           per_page=current_app.config['POSTS_PER_PAGE'],
-                           error_out=False)
-    next_url = url_for('main.messages', page=messages.next_num) \
-        if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) \
-        if messages.has_prev else None
-    return render_template('messages.html', messages=messages.items,
+    messages, next_url, prev_url = _paginate(
+        query, [Message.timestamp, Message.id], 'main.messages')
+    return render_template('messages.html', messages=messages,
                            next_url=next_url, prev_url=prev_url)
 
 
-@bp.route('/notifications')
-@login_required
-def notifications():
-    since = request.args.get('since', 0.0, type=float)
+def _notifications_since(since):
     query = current_user.notifications.select().where(
         Notification.timestamp > since).order_by(Notification.timestamp.asc())
     notifications = db.session.scalars(query)
@@ -215,12 +260,87 @@ def notifications():
         'timestamp': n.timestamp
     } for n in notifications]
 
+
+def _notifications_response(notifications, version):
+    response = make_response(notifications)
+    response.set_etag(repr(version))
+    response.cache_control.no_cache = True
+    return response
+
+
+def _load_notifications(since):
+    notifications = _notifications_since(since)
+    version = notification_events.get_version(current_user.id)
+    if version is None:
+        version = db.session.scalar(sa.select(sa.func.max(
+            Notification.timestamp)).where(
+                Notification.user_id == current_user.id)) or 0
+        notification_events.set_version(current_user.id, version)
+    return _notifications_response(notifications, version)
+
+
+@bp.route('/notifications')
+def notifications():
+    since = request.args.get('since', 0.0, type=float)
+    # đường nhanh: chỉ đọc phiên bản trong Redis theo user id trong session
+    user_id = session.get('_user_id')
+    version = notification_events.get_version(user_id) \
+        if user_id is not None else None
+    if version is not None:
+        if request.if_none_match.contains(repr(version)):
+            response = make_response('', 304)
+            response.set_etag(repr(version))
+            return response
+        if version <= since:
+            return _notifications_response([], version)
+    if not current_user.is_authenticated:
+        return current_app.login_manager.unauthorized()
+    return _load_notifications(since)
+
+
+# Đẩy thông báo bằng Server-Sent Events, /notifications vẫn dùng khi không
+# kết nối được
+@bp.route('/notifications/stream')
+@login_required
+def notifications_stream():
+    since = request.headers.get('Last-Event-ID', type=float) or \
+        request.args.get('since', 0.0, type=float)
+    try:
+        # đăng ký trước khi đọc database để không bỏ lỡ thông báo nào
+        pubsub = notification_events.subscribe(current_user.id)
+    except redis.exceptions.RedisError:
+        return '', 503
+    replay = _notifications_since(since)
+    return Response(
+        notification_events.stream(
+            pubsub, replay,
+            current_app.config['NOTIFICATIONS_STREAM_TIMEOUT'],
+            current_app.config['NOTIFICATIONS_KEEPALIVE']),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @bp.route('/export_posts')
 @login_required
 def export_posts():
     if current_user.get_task_in_progress('export_posts'):
         flash(_('An export task is currently in progress'))
     else:
-        current_user.launch_task('export_posts', _('Exporting posts...'))
+        fmt = request.args.get('format', 'ndjson')
+        current_user.launch_task(
+            'export_posts', _('Exporting posts...'),
+            fmt if fmt in export.FORMATS else 'ndjson', request.url_root,
+            retry=Retry(max=current_app.config['EXPORT_RETRIES'],
+                        interval=current_app.config['EXPORT_RETRY_INTERVAL']))
         db.session.commit()
-    return redirect(url_for('main.user', username=current_user.username))
\ No newline at end of file
+    return redirect(url_for('main.user', username=current_user.username))
+
+@bp.route('/export_posts/<task_id>')
+@login_required
+def download_export(task_id):
+    # chỉ chủ tài khoản tải được; hỗ trợ Range để tải tiếp khi bị ngắt
+    path = current_app.artifacts.get(current_user.id, task_id)
+    if path is None:
+        abort(404)
+    return send_file(path, mimetype='application/gzip', as_attachment=True,
+                     download_name=os.path.basename(path), conditional=True,
+                     max_age=0)
\ No newline at end of file
@@ -1,19 +1,28 @@
 from datetime import datetime, timezone, timedelta
-from hashlib import md5
+from hashlib import md5, sha256
 from time import time
 from typing import Optional
 import sqlalchemy as sa
 import sqlalchemy.orm as so
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from flask import current_app, url_for
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app.search import query_index, query_index_cursor
+from app import notifications, progress as task_progress, queues, \
+    timeline
+from app.revocation import revoked_jti_key
+from app.pagination import CursorPagination, paginate_cursor, encode_cursor, \
+    decode_cursor, cursor_values
 import json
 import redis
 import rq
 import secrets
+from uuid import uuid4
 
 
 # TÌM KIẾM POST
@@ -21,7 +30,8 @@ import secrets
 class SearchableMixin:
     @classmethod
     def search(cls, expression, page, per_page):
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
+        ids, total = current_app.search_cache.query(
+            cls.__tablename__, expression, page, per_page, query_index)
         if total == 0:
             return [], 0
         when = []
@@ -32,34 +42,62 @@ class SearchableMixin:
         return db.session.scalars(query), total
 
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+    def search_cursor(cls, expression, per_page, cursor=None):
+        """Trả về (các object, con trỏ của trang sau)."""
+        ids, next_cursor = current_app.search_cache.query(
+            cls.__tablename__, expression, cursor, per_page,
+            query_index_cursor)
+        if not ids:
+            return [], next_cursor
+        query = sa.select(cls).where(cls.id.in_(ids)).order_by(
+            db.case(*[(id, i) for i, id in enumerate(ids)], value=cls.id))
+        return db.session.scalars(query).all(), next_cursor
+
+    def _searchable_changed(self):
+        # chỉ đánh lại index khi 1 field trong __searchable__ thay đổi
+        state = sa.inspect(self)
+        return any(state.attrs[field].history.has_changes()
+                   for field in self.__searchable__)
 
     @classmethod
-    def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
+    def after_flush(cls, session, flush_context):
+        # id của bài mới chỉ có sau khi flush; lịch sử thay đổi của các field
+        # vẫn còn cho tới khi after_flush chạy xong
+        changes = []
+        for obj in session.new:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
+                changes.append((obj, 'index'))
+        for obj in session.dirty:
+            if isinstance(obj, SearchableMixin) and obj._searchable_changed():
+                changes.append((obj, 'index'))
+        for obj in session.deleted:
             if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+                changes.append((obj, 'delete'))
+        if not changes:
+            return
+        current_app.search_backend.flush(session.connection(), changes)
+        session.info.setdefault('search_changes', []).extend(
+            (obj.__tablename__, obj.id, op,
+             {f: getattr(obj, f) for f in obj.__searchable__}
+             if op == 'index' else None) for obj, op in changes)
 
     @classmethod
-    def reindex(cls):
-        for obj in db.session.scalars(sa.select(cls)):
-            add_to_index(cls.__tablename__, obj)
+    def after_commit(cls, session):
+        current_app.search_backend.commit(
+            session.info.pop('search_changes', []))
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('search_changes', None)
+
+    @classmethod
+    def reindex(cls, **kwargs):
+        return current_app.search_backend.reindex(cls, **kwargs)
 
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
 
 
 # nguoi theo doi
@@ -73,6 +111,13 @@ followers = sa.Table(
 )
 
 class PaginatedAPIMixin(object):
+    # các cột dùng làm con trỏ khi phân trang, sắp xếp giảm dần
+    __cursor__ = ['id']
+
+    @classmethod
+    def cursor_columns(cls):
+        return [getattr(cls, key) for key in cls.__cursor__]
+
     @staticmethod
     #tao dictionary
     def to_collection_dict(query, page, per_page, endpoint, **kwargs):
@@ -97,9 +142,37 @@ class PaginatedAPIMixin(object):
         }
         return data
 
+    # phân trang bằng con trỏ, không đếm tổng số phần tử
+    @classmethod
+    def to_cursor_collection_dict(cls, query, per_page, endpoint, before=None,
+                                  after=None, **kwargs):
+        resources = paginate_cursor(query, cls.cursor_columns(), per_page,
+                                    before=before, after=after)
+        data = {
+            'items': [item.to_dict() for item in resources.items],
+            '_meta': {
+                'per_page': per_page,
+                'next_cursor': resources.next_cursor,
+                'prev_cursor': resources.prev_cursor
+            },
+            '_links': {
+                'self': url_for(endpoint, per_page=per_page, before=before,
+                                after=after, **kwargs),
+                'next': url_for(endpoint, per_page=per_page,
+                                before=resources.next_cursor, **kwargs)
+                if resources.has_next else None,
+                'prev': url_for(endpoint, per_page=per_page,
+                                after=resources.prev_cursor, **kwargs)
+                if resources.has_prev else None
+            }
+        }
+        return data
+
 @login.user_loader
 def load_user(id):
-    return db.session.get(User, int(id))
+    if not current_app.config['USER_CACHE_ENABLED']:
+        return db.session.get(User, int(id))
+    return User.get_cached(int(id))
 
 # TẠO BẢNG USER
 class User(PaginatedAPIMixin, UserMixin, db.Model):
@@ -141,9 +214,85 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     token: so.Mapped[Optional[str]] = so.mapped_column(sa.String(32), index=True, unique=True)
     token_expiration: so.Mapped[Optional[datetime]]
 
+    # Bộ đếm lưu sẵn, cập nhật cùng transaction với follow/unfollow/đăng bài
+    num_posts: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    num_followers: so.Mapped[int] = so.mapped_column(default=0,
+                                                     server_default='0')
+    num_following: so.Mapped[int] = so.mapped_column(default=0,
+                                                     server_default='0')
+    # số tin nhắn chưa đọc, tăng khi nhận tin nhắn, về 0 khi mở trang tin nhắn
+    num_unread_messages: so.Mapped[int] = so.mapped_column(
+        default=0, server_default='0')
+
     def __repr__(self):
         return '<User {}>'.format(self.username)
 
+    # CACHE USER CHO FLASK-LOGIN: LRU TRONG PROCESS, CÓ THỂ THÊM TẦNG REDIS
+    # Khi user thay đổi, mọi process được báo xoá cache qua pub/sub.
+    @staticmethod
+    def get_cached(id):
+        listener = current_app.revocation_listener
+        listener.start()
+        state = current_app.user_cache.get(id)
+        if state is None and current_app.config['USER_CACHE_REDIS']:
+            try:
+                data = current_app.redis.get(f'user-cache:{id}')
+            except redis.exceptions.RedisError:
+                data = None
+            if data is not None:
+                state = User._load_state(data)
+                current_app.user_cache.set(id, state)
+        if state is None:
+            generation = listener.generation
+            user = db.session.get(User, id)
+            # không cache nếu user bị thay đổi trong lúc đang đọc
+            if user is not None and generation == listener.generation:
+                User._cache_user(user)
+            return user
+        # dựng lại object như vừa được query, không cần truy cập database
+        user = User(**state)
+        so.make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    @staticmethod
+    def _dump_state(state):
+        return json.dumps({key: value.isoformat()
+                           if isinstance(value, datetime) else value
+                           for key, value in state.items()})
+
+    @staticmethod
+    def _load_state(data):
+        state = json.loads(data)
+        for attr in sa.inspect(User).column_attrs:
+            value = state.get(attr.key)
+            if value is not None and \
+                    attr.columns[0].type.python_type is datetime:
+                state[attr.key] = datetime.fromisoformat(value)
+        return state
+
+    @staticmethod
+    def _cache_user(user):
+        state = {attr.key: getattr(user, attr.key)
+                 for attr in sa.inspect(User).column_attrs}
+        current_app.user_cache.set(user.id, state)
+        if current_app.config['USER_CACHE_REDIS']:
+            try:
+                current_app.redis.set(f'user-cache:{user.id}',
+                                      User._dump_state(state),
+                                      ex=current_app.config['USER_CACHE_TTL'])
+            except redis.exceptions.RedisError:
+                pass
+
+    @staticmethod
+    def invalidate_cache(id):
+        if current_app.config['USER_CACHE_REDIS']:
+            try:
+                current_app.redis.delete(f'user-cache:{id}')
+            except redis.exceptions.RedisError:
+                pass
+        # xoá cache của process này và báo cho các process khác
+        current_app.revocation_listener.publish(f'user:{id}')
+
     # MÃ HOÁ PASSWORD
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -161,28 +310,42 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     def follow(self, user):
         if not self.is_following(user):
             self.following.add(user)
+            db.session.info.setdefault('timeline_follows', []).append(
+                (self, user, True))
+            self._update_counter('num_following', 1)
+            user._update_counter('num_followers', 1)
 
     # BỎ THEO DÕI
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            db.session.info.setdefault('timeline_follows', []).append(
+                (self, user, False))
+            self._update_counter('num_following', -1)
+            user._update_counter('num_followers', -1)
 
     # KIỂM TRA XEM NGƯỜI ĐÓ ĐÃ THEO DÕI HAY CHƯA (ID USER ĐÓ ĐÃ CÓ TRONG DATA CHƯA)
     def is_following(self, user):
         query = self.following.select().where(User.id == user.id)
         return db.session.scalar(query) is not None
 
+    # CỘNG/TRỪ BỘ ĐẾM BẰNG UPDATE ... SET x = x + 1 ĐỂ KHÔNG BỊ GHI ĐÈ
+    def _update_counter(self, name, delta):
+        db.session.info.setdefault('user_cache_invalidate', set()).add(
+            self.id)
+        if self.id is None:
+            setattr(self, name, (getattr(self, name) or 0) + delta)
+        else:
+            db.session.execute(sa.update(User).where(User.id == self.id).values(
+                {name: getattr(User, name) + delta}))
+
     # ĐẾM SỐ NGƯỜI THEO DÕI MÌNH
     def followers_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.followers.select().subquery())
-        return db.session.scalar(query)
+        return self.num_followers
 
     # ĐẾM SỐ NGƯỜI MÌNH THEO DÕI
     def following_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.following.select().subquery())
-        return db.session.scalar(query)
+        return self.num_following
 
     # NHỮNG BÀI POST CỦA NGƯỜI MÌNH THEO DÕI + BÀI CỦA BẢN THÂN
     def following_posts(self):
@@ -198,9 +361,75 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
                 Author.id == self.id,
                 ))
                 .group_by(Post)
-                .order_by(Post.timestamp.desc())
+                .order_by(Post.timestamp.desc(), Post.id.desc())
         )
 
+    # TRANG CHỦ ĐỌC TỪ TIMELINE TRONG REDIS, NẾU CHƯA CÓ THÌ DỰNG LẠI TỪ SQL
+    def _rebuild_timeline(self):
+        query = self.following_posts().with_only_columns(
+            Post.id, Post.timestamp).limit(
+            current_app.config['TIMELINE_LENGTH'])
+        timeline.rebuild(self.id, db.session.execute(query).all())
+
+    @staticmethod
+    def _posts_by_ids(ids):
+        if not ids:
+            return []
+        when = [(id, i) for i, id in enumerate(ids)]
+        query = sa.select(Post).where(Post.id.in_(ids)).order_by(
+            db.case(*when, value=Post.id))
+        return db.session.scalars(query).all()
+
+    # các tác giả không fan-out mà user đang theo dõi
+    def _timeline_authors(self):
+        celebrities = timeline.celebrities()
+        if not celebrities:
+            return set()
+        query = sa.select(followers.c.followed_id).where(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id.in_(celebrities))
+        return set(db.session.scalars(query))
+
+    # trả về (posts, total, source), source là 'fanout' hoặc 'hybrid'
+    def timeline_posts(self, page, per_page):
+        authors = self._timeline_authors()
+        result = timeline.get_page(self.id, page, per_page, authors)
+        if result is None:
+            self._rebuild_timeline()
+            result = timeline.get_page(self.id, page, per_page, authors)
+        if result is None:
+            return None
+        ids, total = result
+        return self._posts_by_ids(ids), total, \
+            'hybrid' if authors else 'fanout'
+
+    # source của kết quả là 'fanout', 'hybrid' hoặc 'sql'
+    def timeline_page(self, per_page, before=None, after=None):
+        columns = Post.cursor_columns()
+        before_values = decode_cursor(before, columns)
+        after_values = decode_cursor(after, columns)
+        authors = self._timeline_authors()
+        result = timeline.get_cursor_page(self.id, per_page, before_values,
+                                          after_values, authors)
+        if result is None and before_values is None and after_values is None:
+            self._rebuild_timeline()
+            result = timeline.get_cursor_page(self.id, per_page,
+                                              authors=authors)
+        if result is None:
+            posts = paginate_cursor(self.following_posts(), columns, per_page,
+                                    before=before, after=after)
+            posts.source = 'sql'
+            return posts
+        ids, has_next, has_prev = result
+        posts = self._posts_by_ids(ids)
+        next_cursor = encode_cursor(cursor_values(posts[-1], columns)) \
+            if posts and has_next else None
+        prev_cursor = encode_cursor(cursor_values(posts[0], columns)) \
+            if posts and has_prev else None
+        posts = CursorPagination(posts, next_cursor, prev_cursor)
+        posts.source = 'hybrid' if authors else 'fanout'
+        return posts
+
     # Đặt lại mật khẩu
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
@@ -217,21 +446,43 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         return db.session.get(User, id)
 
     def unread_message_count(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        query = sa.select(Message).where(Message.recipient == self, Message.timestamp > last_read_time)
-        return db.session.scalar(sa.select(sa.func.count()).select_from(
-            query.subquery()))
+        return self.num_unread_messages
+
+    def mark_messages_read(self):
+        self.last_message_read_time = datetime.now(timezone.utc)
+        self.num_unread_messages = 0
 
     def add_notification(self, name, data):
-        db.session.execute(self.notifications.delete().where(
-            Notification.name == name))
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
-
-    def launch_task(self, name, description, *args, **kwargs):
-        rq_job = current_app.task_queue.enqueue(f'app.tasks.{name}', self.id,
-                                                *args, **kwargs)
+        """Ghi thông báo `name` (thay thông báo cũ cùng tên) lúc commit. Các
+        lần gọi cùng tên trước khi commit được gộp lại: chỉ giá trị cuối cùng
+        được ghi (1 lệnh upsert) và gửi đi."""
+        if self.id is None:
+            db.session.flush()
+        db.session.info.setdefault('notification_writes', {})[
+            (self.id, name)] = data
+
+    def launch_task(self, name, description, *args, queue=None, **kwargs):
+        """Đưa task vào hàng đợi, hoặc trả về task cùng tên đang chạy của
+        user nếu có (nhiều request cùng lúc chỉ tạo 1 job)."""
+        job_id = str(uuid4())
+        while True:
+            holder = queues.acquire_lock(self.id, name, job_id)
+            if holder is None:
+                break
+            task = db.session.get(Task, holder)
+            if (task is None or not task.complete) and \
+                    queues.job_is_active(holder):
+                # task là None: request khác vừa tạo job nhưng chưa commit
+                return task or Task(id=holder, name=name,
+                                    description=description, user_id=self.id)
+            # khoá của task đã xong, đã lỗi hoặc không còn job
+            queues.release_lock(self.id, name, holder)
+        try:
+            rq_job = queues.get_queue(name, queue).enqueue(
+                f'app.tasks.{name}', self.id, *args, job_id=job_id, **kwargs)
+        except Exception:
+            queues.release_lock(self.id, name, job_id)
+            raise
         task = Task(id=rq_job.get_id(), name=name, description=description,
                     user=self)
         db.session.add(task)
@@ -247,9 +498,7 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         return db.session.scalar(query)
 
     def posts_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.posts.select().subquery())
-        return db.session.scalar(query)
+        return self.num_posts
 
     # chuyen doi user thanh json
     def to_dict(self, include_email=False):
@@ -288,6 +537,9 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         if self.token and self.token_expiration.replace(tzinfo=timezone.utc) > now + timedelta(seconds=60):
             return self.token
 
+        if self.token:
+            # token cũ bị thay thế, xoá khỏi cache của mọi process
+            self._revoke_cached_token(self.token)
         self.token = secrets.token_hex(16)
         self.token_expiration = now + timedelta(seconds=expires_in)
         db.session.add(self)
@@ -296,25 +548,134 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     # Lam mat hieu luc cua token
     def revoke_token(self):
         self.token_expiration = datetime.now(timezone.utc) - timedelta(seconds=1)
+        if self.token:
+            self._revoke_cached_token(self.token)
+
+    @staticmethod
+    def _token_key(token):
+        return sha256(token.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _revoke_cached_token(token):
+        # thông báo sau khi commit, để process khác không đọc lại token cũ
+        db.session.info.setdefault('revoked_tokens', []).append(
+            User._token_key(token))
 
     # Trả về user sở hữu token đó
     @staticmethod
     def check_token(token):
+        key = User._token_key(token)
+        now = datetime.now(timezone.utc)
+        listener = current_app.revocation_listener
+        use_cache = current_app.config['TOKEN_CACHE_ENABLED']
+        if use_cache:
+            listener.start()
+            use_cache = listener.connected
+        if use_cache:
+            cached = current_app.token_cache.get(key)
+            if cached is not None and cached[1] > now:
+                return User.get_cached(cached[0]) \
+                    if current_app.config['USER_CACHE_ENABLED'] \
+                    else db.session.get(User, cached[0])
+            generation = listener.generation
         user = db.session.scalar(sa.select(User).where(User.token == token))
-        if user is None or user.token_expiration.replace(tzinfo=timezone.utc) < datetime.now(timezone.utc):
+        if user is None or user.token_expiration.replace(tzinfo=timezone.utc) < now:
             return None
+        if use_cache and generation == listener.generation:
+            expiration = user.token_expiration.replace(tzinfo=timezone.utc)
+            current_app.token_cache.set(key, (user.id, expiration), ttl=min(
+                (expiration - now).total_seconds(),
+                current_app.config['TOKEN_CACHE_TTL']))
         return user
 
+    # Token JWT ngắn hạn, được kiểm tra bằng chữ ký nên không cần database
+    def get_signed_token(self, expires_in=None):
+        expires_in = expires_in or current_app.config['API_TOKEN_EXPIRES_IN']
+        return jwt.encode(
+            {'api_token': self.id, 'jti': secrets.token_hex(8),
+             'exp': time() + expires_in},
+            current_app.config['SECRET_KEY'], algorithm='HS256')
+
+    @staticmethod
+    def _decode_signed_token(token):
+        try:
+            payload = jwt.decode(token, current_app.config['SECRET_KEY'],
+                                 algorithms=['HS256'])
+        except jwt.InvalidTokenError:
+            return None
+        if 'api_token' not in payload or 'jti' not in payload:
+            return None
+        return payload
+
+    @staticmethod
+    def _is_jti_revoked(jti):
+        listener = current_app.revocation_listener
+        listener.start()
+        # đọc `connected` trước: nếu listener vừa đồng bộ xong giữa 2 bước
+        # thì danh sách trong bộ nhớ đọc sau đó đã đầy đủ
+        connected = listener.connected
+        revoked = current_app.revoked_tokens
+        if revoked.get(jti):
+            return True
+        if connected and not revoked.evictions:
+            # danh sách trong bộ nhớ đang được cập nhật qua pub/sub và chưa
+            # bị bỏ bớt phần tử nào vì đầy
+            return False
+        try:
+            return bool(current_app.redis.exists(revoked_jti_key(jti)))
+        except redis.exceptions.RedisError:
+            return False
+
+    # Thu hồi token JWT: lưu jti tới khi token hết hạn
+    @staticmethod
+    def revoke_signed_token(token):
+        payload = User._decode_signed_token(token)
+        if payload is None:
+            return
+        jti, exp = payload['jti'], payload['exp']
+        try:
+            current_app.redis.set(revoked_jti_key(jti), 1,
+                                  ex=max(int(exp - time()) + 1, 1))
+        except redis.exceptions.RedisError:
+            pass
+        current_app.revocation_listener.publish(f'jti:{jti}:{exp}')
+
+    @staticmethod
+    def check_signed_token(token):
+        payload = User._decode_signed_token(token)
+        if payload is None or User._is_jti_revoked(payload['jti']):
+            return None
+        if current_app.config['USER_CACHE_ENABLED']:
+            return User.get_cached(payload['api_token'])
+        return db.session.get(User, payload['api_token'])
+
+
+def _token_cache_after_commit(session):
+    for key in session.info.pop('revoked_tokens', []):
+        current_app.revocation_listener.publish(f'token:{key}')
+
+
+def _token_cache_after_rollback(session):
+    session.info.pop('revoked_tokens', None)
+
+
+db.event.listen(db.session, 'after_commit', _token_cache_after_commit)
+db.event.listen(db.session, 'after_rollback', _token_cache_after_rollback)
+
 
 # TẠO BẢNG POST
 class Post(PaginatedAPIMixin, SearchableMixin, db.Model):
     __searchable__ = ['body']
+    __cursor__ = ['timestamp', 'id']
     __tablename__ = 'post'
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     body: so.Mapped[str] = so.mapped_column(sa.String(140))
     timestamp: so.Mapped[datetime] = so.mapped_column(index=True, default=lambda: datetime.now(timezone.utc))
     user_id: so.Mapped[str] = so.mapped_column(sa.ForeignKey(User.id), index=True)
-    author: so.Mapped[User] = so.relationship('User', back_populates='posts')
+    # selectin: tác giả của cả danh sách bài post được nạp bằng 1 query IN,
+    # tránh mỗi bài 1 query khi template đọc post.author
+    author: so.Mapped[User] = so.relationship('User', back_populates='posts',
+                                              lazy='selectin')
     # Nối 2 bảng User và Post với nhau bằng relationship
     language: so.Mapped[Optional[str]] = so.mapped_column(sa.String(5))
 
@@ -338,6 +699,119 @@ class Post(PaginatedAPIMixin, SearchableMixin, db.Model):
             if field in data:
                 setattr(self, field, data[field])
 
+# FAN-OUT BÀI POST MỚI VÀO TIMELINE CỦA NGƯỜI THEO DÕI SAU KHI COMMIT
+
+def _recent_posts_query(author_id):
+    return sa.select(Post.id, Post.timestamp).where(
+        Post.user_id == author_id).order_by(Post.timestamp.desc()).limit(
+        current_app.config['TIMELINE_LENGTH'])
+
+
+def _timeline_after_flush(session, flush_context):
+    # dữ liệu phải lấy ngay lúc flush, sau khi commit session không chạy SQL được
+    connection = session.connection()
+    updates = session.info.setdefault('timeline_updates', [])
+    celebrities = None
+    for obj in session.new:
+        if isinstance(obj, Post):
+            query = sa.select(User.num_followers).where(
+                User.id == obj.user_id)
+            if connection.scalar(query) > \
+                    current_app.config['TIMELINE_FANOUT_THRESHOLD']:
+                # quá nhiều người theo dõi: không fan-out, trộn lúc đọc
+                if celebrities is None:
+                    celebrities = timeline.celebrities()
+                if obj.user_id in celebrities:
+                    posts = [(obj.id, obj.timestamp)]
+                else:
+                    # tác giả vừa vượt ngưỡng: danh sách bài gần đây lấy cả
+                    # các bài cũ, để người theo dõi sau này không bị thiếu
+                    posts = connection.execute(
+                        _recent_posts_query(obj.user_id)).all()
+                    celebrities.add(obj.user_id)
+                updates.append((timeline.push_author_posts,
+                                (obj.user_id, posts)))
+                updates.append((timeline.push_post,
+                                ([obj.user_id], obj.id, obj.timestamp)))
+                continue
+            query = sa.select(followers.c.follower_id).where(
+                followers.c.followed_id == obj.user_id)
+            user_ids = [obj.user_id] + list(connection.scalars(query))
+            updates.append((timeline.push_post,
+                            (user_ids, obj.id, obj.timestamp)))
+    for follower, followed, following in session.info.pop(
+            'timeline_follows', []):
+        if following:
+            if celebrities is None:
+                celebrities = timeline.celebrities()
+            if followed.id in celebrities:
+                continue
+            updates.append((timeline.add_posts, (
+                follower.id,
+                connection.execute(_recent_posts_query(followed.id)).all())))
+        else:
+            updates.append((timeline.invalidate, (follower.id,)))
+
+
+def _timeline_after_commit(session):
+    for func, args in session.info.pop('timeline_updates', []):
+        func(*args)
+
+
+def _timeline_after_rollback(session):
+    session.info.pop('timeline_updates', None)
+    session.info.pop('timeline_follows', None)
+
+
+db.event.listen(db.session, 'after_flush', _timeline_after_flush)
+db.event.listen(db.session, 'after_commit', _timeline_after_commit)
+db.event.listen(db.session, 'after_rollback', _timeline_after_rollback)
+
+
+# XOÁ USER KHỎI CACHE SAU KHI COMMIT THAY ĐỔI (SỬA PROFILE, ĐỔI MẬT KHẨU, XOÁ)
+
+def _user_cache_after_flush(session, flush_context):
+    ids = session.info.setdefault('user_cache_invalidate', set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            ids.add(obj.id)
+    for obj in session.new:
+        if isinstance(obj, Post):
+            # bộ đếm bài post của tác giả vừa thay đổi
+            ids.add(obj.user_id)
+        elif isinstance(obj, Message):
+            ids.add(obj.recipient_id)
+
+
+def _user_cache_after_commit(session):
+    for id in session.info.pop('user_cache_invalidate', set()):
+        if id is not None:
+            User.invalidate_cache(id)
+
+
+def _user_cache_after_rollback(session):
+    session.info.pop('user_cache_invalidate', None)
+
+
+db.event.listen(db.session, 'after_flush', _user_cache_after_flush)
+db.event.listen(db.session, 'after_commit', _user_cache_after_commit)
+db.event.listen(db.session, 'after_rollback', _user_cache_after_rollback)
+
+
+# ĐẾM SỐ BÀI POST CỦA TÁC GIẢ NGAY TRONG TRANSACTION INSERT/DELETE POST
+
+@db.event.listens_for(Post, 'after_insert')
+def _post_after_insert(mapper, connection, target):
+    connection.execute(sa.update(User).where(User.id == target.user_id).values(
+        num_posts=User.num_posts + 1))
+
+
+@db.event.listens_for(Post, 'after_delete')
+def _post_after_delete(mapper, connection, target):
+    connection.execute(sa.update(User).where(User.id == target.user_id).values(
+        num_posts=User.num_posts - 1))
+
+
 class Message(db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     sender_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id),
@@ -350,7 +824,7 @@ class Message(db.Model):
 
     author: so.Mapped[User] = so.relationship(
         foreign_keys='Message.sender_id',
-        back_populates='messages_sent')
+        back_populates='messages_sent', lazy='selectin')
     recipient: so.Mapped[User] = so.relationship(
         foreign_keys='Message.recipient_id',
         back_populates='messages_received')
@@ -358,7 +832,60 @@ class Message(db.Model):
     def __repr__(self):
         return '<Message {}>'.format(self.body)
 
+
+@db.event.listens_for(Message, 'after_insert')
+def _message_after_insert(mapper, connection, target):
+    connection.execute(sa.update(User).where(
+        User.id == target.recipient_id).values(
+            num_unread_messages=User.num_unread_messages + 1))
+
+
+def _upsert_notification(user_id, name, payload_json, timestamp):
+    values = {'user_id': user_id, 'name': name, 'payload_json': payload_json,
+              'timestamp': timestamp}
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        insert = sqlite_insert(Notification).values(**values)
+    elif dialect == 'postgresql':
+        insert = postgresql_insert(Notification).values(**values)
+    elif dialect in ('mysql', 'mariadb'):
+        insert = mysql_insert(Notification).values(**values)
+        return insert.on_duplicate_key_update(
+            payload_json=insert.inserted.payload_json,
+            timestamp=insert.inserted.timestamp)
+    else:
+        db.session.execute(sa.delete(Notification).where(
+            Notification.user_id == user_id, Notification.name == name))
+        return sa.insert(Notification).values(**values)
+    return insert.on_conflict_do_update(
+        index_elements=['user_id', 'name'],
+        set_={'payload_json': insert.excluded.payload_json,
+              'timestamp': insert.excluded.timestamp})
+
+
+# GHI CÁC THÔNG BÁO ĐÃ GỘP NGAY TRƯỚC KHI COMMIT
+
+def _notifications_before_commit(session):
+    for (user_id, name), data in session.info.pop(
+            'notification_writes', {}).items():
+        timestamp = time()
+        session.execute(_upsert_notification(user_id, name, json.dumps(data),
+                                             timestamp))
+        notifications.publish(user_id, name, data, timestamp)
+
+
+def _notifications_after_rollback(session):
+    session.info.pop('notification_writes', None)
+
+
+db.event.listen(db.session, 'before_commit', _notifications_before_commit)
+db.event.listen(db.session, 'after_rollback', _notifications_after_rollback)
+
+
 class Notification(db.Model):
+    __table_args__ = (sa.UniqueConstraint('user_id', 'name',
+                                          name='uq_notification_user_id_name'),)
+
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     name: so.Mapped[str] = so.mapped_column(sa.String(128), index=True)
     user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id),
@@ -388,6 +915,8 @@ class Task(db.Model):
         return rq_job
 
     def get_progress(self):
-        job = self.get_rq_job()
-        return job.meta.get('progress', 0) if job is not None else 100
+        progress = task_progress.get(self.id)
+        if progress is None:
+            return 100 if self.complete else 0
+        return progress
 
@@ -0,0 +1,146 @@
+import json
+import time
+import redis
+from flask import current_app
+from app import db
+
+# Thông báo mới (User.add_notification) được gửi qua Redis pub/sub sau khi
+# commit, trên kênh riêng của từng user. Endpoint SSE /notifications/stream
+# ở bất kỳ web worker nào cũng nhận được và đẩy ngay xuống trình duyệt, nên
+# trình duyệt không phải hỏi /notifications mỗi 10 giây nữa. Mỗi kết nối SSE
+# giữ 1 worker, nên cần chạy web bằng worker thread hoặc gevent.
+
+
+# Phiên bản thông báo của user là timestamp của thông báo mới nhất, lưu trong
+# Redis. /notifications?since= so sánh với số này để trả lời ngay khi không có
+# gì mới, không cần tải user hay truy vấn database. Nếu không cập nhật được
+# lúc commit (Redis gián đoạn), phiên bản bị xoá ở lần kết nối được tiếp theo
+# của process; TTL ngắn để các process khác cũng không dùng số cũ quá lâu.
+VERSION_TTL = 300
+
+# id các user có phiên bản trong Redis có thể đã cũ
+_stale = set()
+
+# chỉ tăng, vì các process có thể commit không theo thứ tự timestamp
+_SET_VERSION_SCRIPT = """
+local current = tonumber(redis.call('get', KEYS[1]) or '-1')
+if tonumber(ARGV[1]) > current then
+    redis.call('set', KEYS[1], ARGV[1], 'ex', ARGV[2])
+else
+    redis.call('expire', KEYS[1], ARGV[2])
+end
+"""
+
+
+def channel(user_id):
+    return f'notifications:{user_id}'
+
+
+def _version_key(user_id):
+    return f'notification-version:{user_id}'
+
+
+def _heal():
+    if _stale:
+        user_ids = list(_stale)
+        current_app.redis.delete(*[_version_key(i) for i in user_ids])
+        _stale.difference_update(user_ids)
+
+
+def get_version(user_id):
+    """Timestamp của thông báo mới nhất, None nếu không biết."""
+    try:
+        _heal()
+        version = current_app.redis.get(_version_key(user_id))
+    except redis.exceptions.RedisError:
+        return None
+    return float(version) if version is not None else None
+
+
+def set_version(user_id, version, client=None):
+    script = current_app.redis.register_script(_SET_VERSION_SCRIPT)
+    try:
+        script(keys=[_version_key(user_id)], args=[repr(version), VERSION_TTL],
+               client=client)
+    except redis.exceptions.RedisError:
+        pass
+
+
+def publish(user_id, name, data, timestamp):
+    """Gửi thông báo sau khi session commit."""
+    db.session.info.setdefault('notifications', []).append(
+        (user_id, {'name': name, 'data': data, 'timestamp': timestamp}))
+
+
+def _after_commit(session):
+    pending = session.info.pop('notifications', [])
+    if not pending:
+        return
+    try:
+        _heal()
+        pipe = current_app.redis.pipeline(transaction=False)
+        for user_id, notification in pending:
+            set_version(user_id, notification['timestamp'], client=pipe)
+            pipe.publish(channel(user_id), json.dumps(notification))
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        # trình duyệt vẫn nhận được qua /notifications khi phiên bản cũ bị xoá
+        _stale.update(user_id for user_id, notification in pending)
+
+
+def _after_rollback(session):
+    session.info.pop('notifications', None)
+
+
+db.event.listen(db.session, 'after_commit', _after_commit)
+db.event.listen(db.session, 'after_rollback', _after_rollback)
+
+
+def push(user_id, name, data, client=None):
+    """Gửi ngay 1 thông báo không lưu trong database (vd. tiến độ task),
+    chỉ tới các kết nối SSE đang mở. RedisError nếu Redis không chạy."""
+    notification = {'name': name, 'data': data, 'timestamp': time.time(),
+                    'transient': True}
+    (client or current_app.redis).publish(channel(user_id),
+                                          json.dumps(notification))
+
+
+def subscribe(user_id):
+    """Đăng ký kênh của user, RedisError nếu Redis không chạy."""
+    pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(channel(user_id))
+    return pubsub
+
+
+def _event(notification):
+    data = f"data: {json.dumps(notification)}\n\n"
+    if notification.get('transient'):
+        # không đổi Last-Event-ID, để khi kết nối lại vẫn nhận đủ các thông
+        # báo trong database
+        return data
+    return f"id: {notification['timestamp']}\n" + data
+
+
+def stream(pubsub, replay, timeout, keepalive):
+    """Sinh các sự kiện SSE: trước hết là `replay` (thông báo đã có trong
+    database), sau đó là thông báo mới nhận từ pub/sub cho tới `timeout`
+    giây; trình duyệt sẽ tự kết nối lại với Last-Event-ID."""
+    last = 0
+    try:
+        for notification in replay:
+            last = notification['timestamp']
+            yield _event(notification)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            message = pubsub.get_message(timeout=keepalive)
+            if message is None:
+                yield ': keepalive\n\n'
+                continue
+            notification = json.loads(message['data'])
+            # đã gửi trong phần replay
+            if notification['timestamp'] > last:
+                yield _event(notification)
+    except redis.exceptions.RedisError:
+        pass
+    finally:
+        pubsub.close()
@@ -0,0 +1,102 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+import sqlalchemy as sa
+from app import db
+
+# Phân trang bằng con trỏ (keyset): thay vì OFFSET/LIMIT + COUNT, mỗi trang
+# bắt đầu ngay sau giá trị (timestamp, id) của phần tử cuối trang trước,
+# nên trang thứ 500 cũng chỉ tốn 1 lần seek trên index.
+
+
+class CursorPagination:
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def encode_cursor(values):
+    data = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_values(cursor):
+    """Giải mã con trỏ thành danh sách giá trị JSON, None nếu không hợp lệ."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        data = json.loads(raw)
+    except (binascii.Error, ValueError):
+        return None
+    return data if isinstance(data, list) else None
+
+
+def decode_cursor(cursor, columns):
+    """Giải mã con trỏ thành danh sách giá trị, trả về None nếu không hợp lệ."""
+    data = decode_values(cursor)
+    if data is None or len(data) != len(columns):
+        return None
+    try:
+        return [datetime.fromisoformat(v)
+                if column.type.python_type is datetime else
+                column.type.python_type(v)
+                for column, v in zip(columns, data)]
+    except (binascii.Error, ValueError, TypeError, NotImplementedError):
+        return None
+
+
+def cursor_values(item, columns):
+    return [getattr(item, column.key) for column in columns]
+
+
+def _seek(columns, values, older):
+    # (c1, c2) < (v1, v2)  <=>  c1 < v1 OR (c1 = v1 AND c2 < v2)
+    condition = None
+    for column, value in reversed(list(zip(columns, values))):
+        compare = column < value if older else column > value
+        condition = compare if condition is None else sa.or_(
+            compare, sa.and_(column == value, condition))
+    return condition
+
+
+def paginate_cursor(query, columns, per_page, before=None, after=None):
+    """Phân trang query theo các cột `columns` giảm dần, không dùng COUNT."""
+    before_values = decode_cursor(before, columns)
+    after_values = decode_cursor(after, columns)
+    query = query.order_by(None)
+    if after_values is not None:
+        query = query.where(_seek(columns, after_values, older=False)) \
+            .order_by(*[column.asc() for column in columns]) \
+            .limit(per_page + 1)
+        items = db.session.scalars(query).all()
+        has_prev = len(items) > per_page
+        items = list(reversed(items[:per_page]))
+        has_next = True
+    else:
+        if before_values is not None:
+            query = query.where(_seek(columns, before_values, older=True))
+        query = query.order_by(*[column.desc() for column in columns]) \
+            .limit(per_page + 1)
+        items = db.session.scalars(query).all()
+        has_next = len(items) > per_page
+        items = items[:per_page]
+        has_prev = before_values is not None
+    if not items:
+        return CursorPagination(items, None, None)
+    next_cursor = encode_cursor(cursor_values(items[-1], columns)) \
+        if has_next else None
+    prev_cursor = encode_cursor(cursor_values(items[0], columns)) \
+        if has_prev else None
+    return CursorPagination(items, next_cursor, prev_cursor)
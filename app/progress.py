@@ -0,0 +1,53 @@
+import time
+import redis
+from flask import current_app
+from app import notifications
+
+# Tiến độ của task nền chỉ nằm trong Redis (1 hash mỗi task) và được đẩy
+# thẳng tới trình duyệt qua kênh thông báo của user, không ghi database.
+# Mỗi task được cập nhật nhiều nhất TASK_PROGRESS_RATE lần/giây; bảng task
+# và bảng notification chỉ được ghi lúc bắt đầu và kết thúc.
+
+PROGRESS_TTL = 24 * 3600
+
+# thời điểm cập nhật gần nhất của các task đang chạy trong process này
+_last_update = {}
+
+
+def _key(task_id):
+    return f'task-progress:{task_id}'
+
+
+def update(task_id, user_id, progress, force=False):
+    """Ghi tiến độ và gửi tới user; bỏ qua nếu vừa cập nhật, trừ khi
+    `force`. Trả về True nếu đã ghi."""
+    now = time.monotonic()
+    last = _last_update.get(task_id)
+    if not force and last is not None and \
+            now - last < 1 / current_app.config['TASK_PROGRESS_RATE']:
+        return False
+    if progress >= 100:
+        _last_update.pop(task_id, None)
+    else:
+        _last_update[task_id] = now
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        pipe.hset(_key(task_id), mapping={'progress': progress,
+                                          'updated': time.time()})
+        pipe.expire(_key(task_id), PROGRESS_TTL)
+        notifications.push(user_id, 'task_progress',
+                           {'task_id': task_id, 'progress': progress},
+                           client=pipe)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        return False
+    return True
+
+
+def get(task_id):
+    """Tiến độ gần nhất của task, None nếu không biết."""
+    try:
+        progress = current_app.redis.hget(_key(task_id), 'progress')
+    except redis.exceptions.RedisError:
+        return None
+    return int(progress) if progress is not None else None
@@ -0,0 +1,186 @@
+import multiprocessing
+import signal
+import time
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from redis import Redis
+import rq
+
+# Task nền được chia vào các hàng đợi theo độ ưu tiên (TASK_QUEUES), mỗi hàng
+# đợi có nhóm worker riêng, nên một loạt task nặng (xuất bài post) không làm
+# chậm các task cần chạy ngay. Task được đưa vào hàng đợi theo TASK_ROUTES,
+# mặc định là 'default'.
+
+# Mỗi user chỉ chạy 1 task cùng tên tại 1 thời điểm: launch_task giữ khoá
+# task-lock:<user_id>:<name> (SET NX) với giá trị là id của job, nên nhiều
+# request gần như cùng lúc chỉ tạo 1 job. Khoá được giải phóng khi task xong,
+# hoặc tự hết hạn sau TASK_LOCK_TTL giây nếu worker chết.
+
+# Task định kỳ (vd. cleanup_artifacts) tự hẹn chạy lại sau mỗi lần chạy; id
+# của job kế tiếp nằm trong task-schedule:<name>, nên chạy lệnh hẹn nhiều lần
+# vẫn chỉ có 1 chuỗi job.
+
+# chỉ xoá khoá nếu vẫn do job này giữ
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def queue_name(name):
+    # hàng đợi 'default' giữ tên cũ để các job đang chờ vẫn được chạy
+    return 'microblog-tasks' if name == 'default' else f'microblog-{name}'
+
+
+def create_queues(app):
+    return {name: rq.Queue(queue_name(name), connection=app.redis)
+            for name in app.config['TASK_QUEUES']}
+
+
+def get_queue(task_name, queue=None):
+    """Hàng đợi cho task `task_name`, hoặc hàng đợi `queue` nếu có."""
+    queue = queue or current_app.config['TASK_ROUTES'].get(task_name,
+                                                           'default')
+    try:
+        return current_app.task_queues[queue]
+    except KeyError:
+        raise ValueError(f'Unknown task queue: {queue}') from None
+
+
+def _lock_key(user_id, name):
+    return f'task-lock:{user_id}:{name}'
+
+
+def acquire_lock(user_id, name, job_id):
+    """Giữ khoá task `name` của user cho `job_id`. Trả về None nếu giữ được,
+    không thì id của job đang giữ khoá."""
+    key = _lock_key(user_id, name)
+    ttl = current_app.config['TASK_LOCK_TTL']
+    while True:
+        if current_app.redis.set(key, job_id, nx=True, ex=ttl):
+            return None
+        holder = current_app.redis.get(key)
+        # nếu khoá vừa được giải phóng thì thử lại
+        if holder is not None:
+            return holder.decode('utf-8')
+
+
+def release_lock(user_id, name, job_id):
+    script = current_app.redis.register_script(_RELEASE_SCRIPT)
+    script(keys=[_lock_key(user_id, name)], args=[job_id])
+
+
+def job_is_active(job_id):
+    """True nếu job còn chờ, đang chạy hoặc đang chờ chạy lại; False nếu đã
+    xong, đã lỗi, bị huỷ hoặc không còn trong Redis."""
+    try:
+        job = rq.job.Job.fetch(job_id, connection=current_app.redis)
+    except rq.exceptions.NoSuchJobError:
+        return False
+    return job.get_status() not in (
+        rq.job.JobStatus.FINISHED, rq.job.JobStatus.FAILED,
+        rq.job.JobStatus.STOPPED, rq.job.JobStatus.CANCELED)
+
+
+def _schedule_key(name):
+    return f'task-schedule:{name}'
+
+
+def scheduled_job_id(name):
+    """Id của job kế tiếp (hoặc đang chạy) của task định kỳ `name`, None nếu
+    chưa được hẹn."""
+    job_id = current_app.redis.get(_schedule_key(name))
+    if job_id is None:
+        return None
+    job_id = job_id.decode('utf-8')
+    return job_id if job_is_active(job_id) else None
+
+
+def schedule_periodic(name, interval, delay=None):
+    """Chạy task định kỳ `name` sau `delay` giây (ngay nếu không có) và ghi
+    nhận đó là job kế tiếp của task."""
+    queue = get_queue(name)
+    if delay:
+        job = queue.enqueue_in(timedelta(seconds=delay), f'app.tasks.{name}',
+                               interval)
+    else:
+        job = queue.enqueue(f'app.tasks.{name}', interval)
+    current_app.redis.set(_schedule_key(name), job.get_id())
+    return job
+
+
+def parse_pools(value):
+    """'high=2,default=2,bulk=1' -> {'high': 2, 'default': 2, 'bulk': 1}"""
+    pools = {}
+    for item in value.split(','):
+        name, _, count = item.strip().partition('=')
+        pools[name] = int(count or 1)
+    return pools
+
+
+def stats(queues):
+    """Số job đang chờ, đang chạy, lỗi, số worker và tuổi (giây) của job chờ
+    lâu nhất trong mỗi hàng đợi."""
+    now = datetime.now(timezone.utc)
+    result = []
+    for name, queue in queues.items():
+        latency = 0.0
+        oldest = queue.get_job_ids(0, 1)
+        job = queue.fetch_job(oldest[0]) if oldest else None
+        if job is not None and job.enqueued_at is not None:
+            enqueued_at = job.enqueued_at.replace(tzinfo=timezone.utc)
+            latency = max((now - enqueued_at).total_seconds(), 0.0)
+        result.append({'queue': name, 'queued': queue.count,
+                       'started': queue.started_job_registry.count,
+                       'failed': queue.failed_job_registry.count,
+                       'workers': rq.Worker.count(queue=queue),
+                       'latency': latency})
+    return result
+
+
+def _work(redis_url, queue):
+    connection = Redis.from_url(redis_url)
+    rq.Worker([rq.Queue(queue, connection=connection)],
+              connection=connection).work(with_scheduler=True)
+
+
+def run_workers(redis_url, pools, echo=print):
+    """Chạy `pools[name]` process worker cho mỗi hàng đợi, khởi động lại
+    process bị chết, dừng tất cả khi nhận SIGINT/SIGTERM."""
+    context = multiprocessing.get_context('spawn')
+    processes = {}
+    stopping = None
+
+    def start(name, slot):
+        process = context.Process(target=_work,
+                                  args=(redis_url, queue_name(name)),
+                                  name=f'{name}-{slot}', daemon=False)
+        process.start()
+        processes[(name, slot)] = process
+        echo(f'started worker {process.name} (pid {process.pid})')
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = signum
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for name, count in pools.items():
+        for slot in range(count):
+            start(name, slot)
+    while stopping is None:
+        time.sleep(1)
+        for (name, slot), process in list(processes.items()):
+            if stopping is None and not process.is_alive():
+                echo(f'worker {process.name} exited with code '
+                     f'{process.exitcode}, restarting')
+                start(name, slot)
+    if stopping != signal.SIGINT:
+        # Ctrl-C đã tới cả các process con; gửi thêm tín hiệu thì rq dừng
+        # ngay (cold shutdown) thay vì chờ chạy xong job hiện tại
+        for process in processes.values():
+            process.terminate()
+    for process in processes.values():
+        process.join()
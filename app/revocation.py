@@ -0,0 +1,111 @@
+import threading
+import time
+import redis
+
+# Kênh Redis pub/sub báo cho mọi process biết token nào vừa bị thu hồi hoặc
+# user nào vừa thay đổi, để xoá khỏi cache trong bộ nhớ của process đó.
+CHANNEL = 'token-revocations'
+
+
+class RevocationListener:
+    """Thread nền nhận thông báo thu hồi token và gọi các handler.
+
+    Cache token chỉ được dùng khi `connected` là True: lúc mất kết nối tới
+    Redis, process có thể bỏ lỡ thông báo nên phải kiểm tra lại database.
+    `generation` tăng mỗi khi có thông báo, dùng để tránh ghi vào cache một
+    kết quả đọc từ database trước khi token bị thu hồi."""
+
+    def __init__(self, app, reconnect_delay=5):
+        self.app = app
+        self.reconnect_delay = reconnect_delay
+        self.connected = False
+        self.generation = 0
+        self.handlers = []
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _notify(self, message):
+        self.generation += 1
+        for handler in self.handlers:
+            handler(message)
+
+    def _run(self):
+        while True:
+            try:
+                pubsub = self.app.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                # có thể đã bỏ lỡ thông báo trong lúc mất kết nối
+                self._notify(None)
+                self.connected = True
+                for message in pubsub.listen():
+                    self._notify(message['data'].decode('utf-8'))
+            except redis.exceptions.RedisError:
+                pass
+            self.connected = False
+            time.sleep(self.reconnect_delay)
+
+    def publish(self, message):
+        self._notify(message)
+        try:
+            self.app.redis.publish(CHANNEL, message)
+        except redis.exceptions.RedisError:
+            pass
+
+
+def token_cache_handler(cache):
+    """Handler xoá token bị thu hồi khỏi cache, thông báo None xoá toàn bộ."""
+    def handler(message):
+        if message is None:
+            cache.clear()
+        elif message.startswith('token:'):
+            cache.delete(message[len('token:'):])
+    return handler
+
+
+def user_cache_handler(cache):
+    """Handler xoá user vừa thay đổi khỏi cache, thông báo None xoá toàn
+    bộ."""
+    def handler(message):
+        if message is None:
+            cache.clear()
+        elif message.startswith('user:'):
+            cache.delete(int(message[len('user:'):]))
+    return handler
+
+
+def revoked_jti_key(jti):
+    return f'revoked-jti:{jti}'
+
+
+def jti_revocation_handler(app, revoked):
+    """Handler ghi jti của token JWT bị thu hồi vào danh sách trong bộ nhớ.
+
+    Thông báo có dạng `jti:<jti>:<exp>`, thông báo None (vừa kết nối lại) thì
+    đọc lại toàn bộ danh sách thu hồi trong Redis."""
+    def handler(message):
+        if message is None:
+            try:
+                keys = list(app.redis.scan_iter(match=revoked_jti_key('*')))
+                pipe = app.redis.pipeline(transaction=False)
+                for key in keys:
+                    pipe.ttl(key)
+                for key, ttl in zip(keys, pipe.execute()):
+                    if ttl > 0:
+                        jti = key.decode('utf-8').split(':', 1)[1]
+                        revoked.set(jti, True, ttl=ttl)
+            except redis.exceptions.RedisError:
+                pass
+        elif message.startswith('jti:'):
+            jti, exp = message[len('jti:'):].rsplit(':', 1)
+            ttl = float(exp) - time.time()
+            if ttl > 0:
+                revoked.set(jti, True, ttl=ttl)
+    return handler
@@ -0,0 +1,87 @@
+from flask import current_app
+from app.pagination import encode_cursor, decode_values
+
+# Các hàm tìm kiếm dùng backend được chọn bằng SEARCH_BACKEND:
+# 'elasticsearch', 'sqlite' (FTS5, ngay trong database, không cần thêm dịch
+# vụ), 'memory' (inverted index trong process) hoặc 'none'. Mặc định dùng
+# Elasticsearch nếu có ELASTICSEARCH_URL, không thì dùng sqlite nếu database
+# là sqlite.
+
+
+class SearchBackend:
+    """Backend không làm gì, các backend khác kế thừa lớp này."""
+
+    def add(self, index, model):
+        pass
+
+    def remove(self, index, model):
+        pass
+
+    def query(self, index, query, page, per_page):
+        return [], 0
+
+    def query_after(self, index, query, per_page, after):
+        """Trả về (ids, sort) của trang kết quả nằm sau `after`, xếp theo
+        điểm rồi id giảm dần; `sort` là giá trị [điểm, id] của kết quả cuối
+        trang, None nếu không còn trang sau."""
+        return [], None
+
+    def flush(self, connection, changes):
+        """Gọi trong after_flush với các cặp (object, op), op là
+        index/delete; ghi vào `connection` thì nằm cùng transaction."""
+        pass
+
+    def commit(self, changes):
+        """Gọi sau khi commit với các bộ (index, id, op, payload), payload
+        là giá trị các field trong __searchable__ (None khi xoá)."""
+        pass
+
+    def reindex(self, cls, **kwargs):
+        return 0, 0
+
+
+def create_backend(app):
+    name = app.config['SEARCH_BACKEND']
+    if name is None:
+        if app.config['ELASTICSEARCH_URL']:
+            name = 'elasticsearch'
+        elif app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+            name = 'sqlite'
+        else:
+            name = 'none'
+    if name == 'elasticsearch':
+        from app.search.elastic import ElasticsearchBackend
+        return ElasticsearchBackend()
+    if name == 'sqlite':
+        from app.search.sqlite import SQLiteBackend
+        return SQLiteBackend()
+    if name == 'memory':
+        from app.search.memory import MemoryBackend
+        return MemoryBackend(app.config['SEARCH_MEMORY_SNAPSHOT'])
+    if name == 'none':
+        return SearchBackend()
+    raise ValueError(f'Unknown search backend: {name}')
+
+
+def add_to_index(index, model):
+    current_app.search_backend.add(index, model)
+
+
+def remove_from_index(index, model):
+    current_app.search_backend.remove(index, model)
+
+
+def query_index(index, query, page, per_page):
+    return current_app.search_backend.query(index, query, page, per_page)
+
+
+def query_index_cursor(index, query, cursor, per_page):
+    """Như query_index nhưng phân trang bằng con trỏ (search_after), trang
+    sâu tốn như trang đầu. Trả về (ids, con trỏ của trang sau)."""
+    after = decode_values(cursor)
+    if after is not None and (len(after) != 2 or not all(
+            isinstance(v, (int, float)) for v in after)):
+        after = None
+    ids, last = current_app.search_backend.query_after(index, query,
+                                                       per_page, after)
+    return ids, encode_cursor(last) if last is not None else None
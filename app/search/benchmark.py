@@ -0,0 +1,94 @@
+import heapq
+import random
+import string
+import time
+from elasticsearch import helpers
+from app.search.memory import InvertedIndex
+
+# So sánh backend 'memory' với Elasticsearch trên 1 tập bài viết sinh ngẫu
+# nhiên, tần suất từ theo phân phối Zipf giống văn bản thật.
+
+
+def corpus(docs, seed=1, vocabulary_size=5000):
+    rng = random.Random(seed)
+    vocabulary = [''.join(rng.choices(string.ascii_lowercase,
+                                      k=rng.randint(3, 9)))
+                  for _ in range(vocabulary_size)]
+    weights = [1 / (rank + 1) for rank in range(vocabulary_size)]
+    return [' '.join(rng.choices(vocabulary, weights, k=rng.randint(5, 40)))
+            for _ in range(docs)], vocabulary
+
+
+def queries(texts, vocabulary, count, seed=1):
+    """Câu truy vấn gồm 2 từ, cụm từ lấy từ 1 bài, hoặc tiền tố*."""
+    rng = random.Random(seed)
+    result = []
+    for i in range(count):
+        if i % 4 == 0:
+            words = rng.choice(texts).split()
+            start = rng.randrange(max(len(words) - 2, 1))
+            result.append('"' + ' '.join(words[start:start + 3]) + '"')
+        elif i % 4 == 1:
+            result.append(rng.choice(vocabulary)[:3] + '*')
+        else:
+            result.append(' '.join(rng.sample(vocabulary[:1000], 2)))
+    return result
+
+
+def _measure(search, queries):
+    latencies = []
+    start = time.perf_counter()
+    for query in queries:
+        t = time.perf_counter()
+        search(query)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {'p50': latencies[len(latencies) // 2] * 1000,
+            'p95': latencies[int(len(latencies) * 0.95)] * 1000,
+            'qps': len(queries) / elapsed}
+
+
+def _memory(texts, queries, size):
+    start = time.perf_counter()
+    index = InvertedIndex()
+    for doc, text in enumerate(texts, 1):
+        index.add(doc, [text])
+    index_time = time.perf_counter() - start
+
+    def search(query):
+        return heapq.nlargest(size, index.search(query).items(),
+                              key=lambda item: (item[1], item[0]))
+
+    return {'backend': 'memory', 'index_time': index_time,
+            **_measure(search, queries)}
+
+
+def _elasticsearch(client, texts, queries, size):
+    name = f'benchmark-{int(time.time())}'
+    start = time.perf_counter()
+    client.indices.create(index=name)
+    try:
+        helpers.bulk(client, ({'_index': name, '_id': doc,
+                               '_source': {'body': text}}
+                              for doc, text in enumerate(texts, 1)))
+        client.indices.refresh(index=name)
+        index_time = time.perf_counter() - start
+
+        def search(query):
+            return client.search(index=name, size=size, query={
+                'simple_query_string': {'query': query, 'fields': ['body']}})
+
+        return {'backend': 'elasticsearch', 'index_time': index_time,
+                **_measure(search, queries)}
+    finally:
+        client.indices.delete(index=name)
+
+
+def run(docs, count, elasticsearch=None, seed=1, size=10):
+    texts, vocabulary = corpus(docs, seed)
+    query_list = queries(texts, vocabulary, count, seed)
+    results = [_memory(texts, query_list, size)]
+    if elasticsearch:
+        results.append(_elasticsearch(elasticsearch, texts, query_list, size))
+    return results
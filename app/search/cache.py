@@ -0,0 +1,83 @@
+import time
+import redis
+from flask import current_app
+from app.cache import TTLCache
+
+# Cache kết quả tìm kiếm (danh sách id và tổng số) trong bộ nhớ của process.
+# Mỗi index có 1 số thế hệ trong Redis, tăng lên mỗi khi index thay đổi; số
+# này nằm trong khoá cache nên kết quả cũ tự hết hiệu lực mà không phải xoá.
+# Số hit/miss của mọi process được cộng dồn vào 1 hash trong Redis.
+
+STATS_KEY = 'search-cache-stats'
+
+
+def _generation_key(index):
+    return f'search-generation:{index}'
+
+
+def bump(indexes):
+    """Tăng số thế hệ của các index vừa thay đổi."""
+    indexes = set(indexes)
+    if not indexes:
+        return
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for index in indexes:
+            pipe.incr(_generation_key(index))
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        pass
+
+
+def normalize(expression):
+    return ' '.join(expression.lower().split())
+
+
+class SearchCache:
+    def __init__(self, app, report_interval=10):
+        self.app = app
+        self.cache = TTLCache(app.config['SEARCH_CACHE_SIZE'],
+                              app.config['SEARCH_CACHE_TTL'])
+        self.report_interval = report_interval
+        self._reported = (0, 0)
+        self._last_report = time.monotonic()
+
+    def query(self, index, expression, page, per_page, query):
+        """Trả về kết quả của `query(index, expression, page, per_page)`,
+        lấy từ cache nếu index chưa thay đổi."""
+        if not self.cache.maxsize:
+            return query(index, expression, page, per_page)
+        try:
+            generation = self.app.redis.get(_generation_key(index))
+        except redis.exceptions.RedisError:
+            # không biết index đã thay đổi hay chưa
+            return query(index, expression, page, per_page)
+        key = (index, generation, normalize(expression), page, per_page)
+        result = self.cache.get(key)
+        if result is None:
+            result = query(index, expression, page, per_page)
+            self.cache.set(key, result)
+        self._report()
+        return result
+
+    def _report(self):
+        if time.monotonic() - self._last_report < self.report_interval:
+            return
+        hits, misses = self.cache.hits, self.cache.misses
+        try:
+            pipe = self.app.redis.pipeline(transaction=False)
+            pipe.hincrby(STATS_KEY, 'hits', hits - self._reported[0])
+            pipe.hincrby(STATS_KEY, 'misses', misses - self._reported[1])
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            return
+        self._reported = (hits, misses)
+        self._last_report = time.monotonic()
+
+    def stats(self):
+        """Số hit/miss của mọi process (đã được báo về Redis)."""
+        stats = {key.decode('utf-8'): int(value) for key, value in
+                 self.app.redis.hgetall(STATS_KEY).items()}
+        hits, misses = stats.get('hits', 0), stats.get('misses', 0)
+        return {'hits': hits, 'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
@@ -0,0 +1,60 @@
+from flask import current_app
+from app import indexing
+from app.search import SearchBackend
+
+# ELASTIC SEARCH là công cụ tìm kiếm, có thể đc xem như 1 document oriented database
+# Nó như 1 bản copy của database và việc tìm kiếm sẽ đc thực hiện trên đó
+
+# Thay vì tìm kiếm trên database gốc thì chuyển data dó sang Elastic search và tìm kiếm trên đó.
+
+
+class ElasticsearchBackend(SearchBackend):
+    def add(self, index, model):
+        if not current_app.elasticsearch:
+            return
+        payload = {'id': model.id}
+        for field in model.__searchable__:
+            payload[field] = getattr(model, field)
+        current_app.elasticsearch.index(index=index, id=model.id,
+                                        body=payload)
+
+    def remove(self, index, model):
+        if not current_app.elasticsearch:
+            return
+        current_app.elasticsearch.delete(index=index, id=model.id)
+
+    def _query(self, index, query):
+        # chỉ tìm trong các field của __searchable__, không tìm trong id
+        fields = indexing.searchable_models()[index].__searchable__
+        return {'multi_match': {'query': query, 'fields': fields}}
+
+    def query(self, index, query, page, per_page):
+        if not current_app.elasticsearch:
+            return [], 0
+        search = current_app.elasticsearch.search(
+            index=index,
+            body={'query': self._query(index, query),
+                  'from': (page - 1) * per_page, 'size': per_page})
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+        # ids: danh sach cac phan tu. search[][][]: tong ket qua
+        return ids, search['hits']['total']['value']
+
+    def query_after(self, index, query, per_page, after):
+        if not current_app.elasticsearch:
+            return [], None
+        body = {'query': self._query(index, query), 'size': per_page + 1,
+                'sort': [{'_score': 'desc'}, {'id': 'desc'}],
+                'track_total_hits': False}
+        if after is not None:
+            body['search_after'] = after
+        hits = current_app.elasticsearch.search(index=index,
+                                                body=body)['hits']['hits']
+        last = hits[per_page - 1]['sort'] if len(hits) > per_page else None
+        return [int(hit['_id']) for hit in hits[:per_page]], last
+
+    def commit(self, changes):
+        # worker `flask search worker` sẽ gửi các thay đổi theo lô
+        indexing.enqueue([change[:3] for change in changes])
+
+    def reindex(self, cls, **kwargs):
+        return indexing.reindex(cls, **kwargs)
@@ -0,0 +1,339 @@
+from array import array
+import atexit
+import bisect
+import heapq
+from itertools import accumulate
+import math
+import os
+import pickle
+import re
+import sys
+import threading
+import unicodedata
+import sqlalchemy as sa
+from app import db
+from app.search import SearchBackend, cache
+
+# Inverted index nằm trong bộ nhớ của process, không cần Elasticsearch hay
+# extension của database. Mỗi từ có 1 danh sách posting gồm id các document
+# (tăng dần, lưu hiệu số trong array), số lần xuất hiện và vị trí của từ
+# trong document (để tìm cụm từ). Chỉ dùng được khi web chạy 1 process, vì
+# mỗi process có index riêng và chỉ thấy thay đổi do chính nó commit.
+
+_TOKEN = re.compile(r'\w+')
+_QUERY = re.compile(r'"([^"]*)"|(\S+)')
+# khoảng cách vị trí giữa các field để cụm từ không khớp qua 2 field
+_FIELD_GAP = 100
+_MAX_EXPANSIONS = 64
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return _TOKEN.findall(text)
+
+
+def _deltas(values):
+    out = array('I')
+    previous = 0
+    for value in values:
+        out.append(value - previous)
+        previous = value
+    return out
+
+
+class Postings:
+    """Danh sách posting của 1 từ, mọi số nguyên được lưu trong array."""
+
+    __slots__ = ('docs', 'freqs', 'positions', 'last')
+
+    def __init__(self):
+        self.docs = array('I')
+        self.freqs = array('I')
+        self.positions = array('I')
+        self.last = 0
+
+    def __len__(self):
+        return len(self.freqs)
+
+    def frequencies(self):
+        return zip(accumulate(self.docs), self.freqs)
+
+    def entries(self):
+        offset = 0
+        for doc, freq in self.frequencies():
+            yield doc, list(accumulate(
+                self.positions[offset:offset + freq]))
+            offset += freq
+
+    def _append(self, doc, positions):
+        self.docs.append(doc - self.last)
+        self.freqs.append(len(positions))
+        self.positions.extend(_deltas(positions))
+        self.last = doc
+
+    def _rebuild(self, entries):
+        self.docs, self.freqs, self.positions = array('I'), array('I'), \
+            array('I')
+        self.last = 0
+        for doc, positions in entries:
+            self._append(doc, positions)
+
+    def add(self, doc, positions):
+        if doc > self.last:
+            # trường hợp thường gặp: bài mới có id lớn nhất
+            self._append(doc, positions)
+        else:
+            entries = [e for e in self.entries() if e[0] != doc]
+            bisect.insort(entries, (doc, positions))
+            self._rebuild(entries)
+
+    def remove(self, doc):
+        self._rebuild([e for e in self.entries() if e[0] != doc])
+
+
+class InvertedIndex:
+    def __init__(self):
+        self.postings = {}
+        self.lengths = {}
+        self.doc_terms = {}
+        self.total_length = 0
+        self.lock = threading.RLock()
+        self._vocabulary = None
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def last_id(self):
+        return max(self.lengths, default=0)
+
+    def add(self, doc, texts):
+        with self.lock:
+            self.remove(doc)
+            positions = {}
+            position = 0
+            for text in texts:
+                for token in tokenize(text or ''):
+                    positions.setdefault(token, []).append(position)
+                    position += 1
+                position += _FIELD_GAP
+            for term, term_positions in positions.items():
+                postings = self.postings.get(term)
+                if postings is None:
+                    postings = self.postings[sys.intern(term)] = Postings()
+                    self._vocabulary = None
+                postings.add(doc, term_positions)
+            length = sum(len(p) for p in positions.values())
+            self.lengths[doc] = length
+            self.total_length += length
+            self.doc_terms[doc] = tuple(positions)
+
+    def remove(self, doc):
+        with self.lock:
+            if doc not in self.lengths:
+                return
+            for term in self.doc_terms.pop(doc):
+                postings = self.postings[term]
+                postings.remove(doc)
+                if not len(postings):
+                    del self.postings[term]
+                    self._vocabulary = None
+            self.total_length -= self.lengths.pop(doc)
+
+    def _bm25(self, term, docs=None):
+        postings = self.postings.get(term)
+        if postings is None:
+            return {}
+        n = len(self.lengths)
+        idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+        average = self.total_length / n
+        scores = {}
+        for doc, freq in postings.frequencies():
+            if docs is None or doc in docs:
+                norm = K1 * (1 - B + B * self.lengths[doc] / average)
+                scores[doc] = idf * freq * (K1 + 1) / (freq + norm)
+        return scores
+
+    def _phrase(self, terms):
+        postings = [self.postings.get(term) for term in terms]
+        if not all(postings):
+            return {}
+        candidates = set.intersection(
+            *[{doc for doc, freq in p.frequencies()} for p in postings])
+        positions = [{doc: set(pos) for doc, pos in p.entries()
+                      if doc in candidates} for p in postings]
+        # vị trí của từ thứ i trừ đi i phải trùng nhau ở mọi từ
+        docs = {doc for doc in candidates if set.intersection(
+            *[{p - i for p in positions[i][doc]} for i in range(len(terms))])}
+        scores = {}
+        for term in terms:
+            for doc, score in self._bm25(term, docs).items():
+                scores[doc] = scores.get(doc, 0) + score
+        return scores
+
+    def _prefix(self, prefix):
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self.postings)
+        start = bisect.bisect_left(self._vocabulary, prefix)
+        terms = []
+        for term in self._vocabulary[start:start + _MAX_EXPANSIONS]:
+            if not term.startswith(prefix):
+                break
+            terms.append(term)
+        return terms
+
+    def search(self, query):
+        """Trả về {id: điểm BM25}; hỗ trợ "cụm từ" và tiền tố*, các phần
+        của câu truy vấn được nối bằng OR như multi_match."""
+        with self.lock:
+            if not self.lengths:
+                return {}
+            clauses = []
+            for phrase, word in _QUERY.findall(query):
+                if phrase:
+                    terms = tokenize(phrase)
+                    if len(terms) > 1:
+                        clauses.append(self._phrase(terms))
+                    elif terms:
+                        clauses.append(self._bm25(terms[0]))
+                elif word.endswith('*') and tokenize(word):
+                    for term in self._prefix(tokenize(word)[0]):
+                        clauses.append(self._bm25(term))
+                else:
+                    clauses.extend(self._bm25(t) for t in tokenize(word))
+            scores = {}
+            for clause in clauses:
+                for doc, score in clause.items():
+                    scores[doc] = scores.get(doc, 0) + score
+            return scores
+
+    def __getstate__(self):
+        with self.lock:
+            return {'postings': {term: (p.docs, p.freqs, p.positions, p.last)
+                                 for term, p in self.postings.items()},
+                    'lengths': self.lengths, 'doc_terms': self.doc_terms,
+                    'total_length': self.total_length}
+
+    def __setstate__(self, state):
+        self.__init__()
+        for term, (docs, freqs, positions, last) in state['postings'].items():
+            postings = self.postings[sys.intern(term)] = Postings()
+            postings.docs, postings.freqs, postings.positions, \
+                postings.last = docs, freqs, positions, last
+        self.lengths = state['lengths']
+        self.doc_terms = state['doc_terms']
+        self.total_length = state['total_length']
+
+
+def _rows(cls, after_id=0, chunk_size=1000):
+    columns = [getattr(cls, field) for field in cls.__searchable__]
+    while True:
+        rows = db.session.execute(sa.select(cls.id, *columns).where(
+            cls.id > after_id).order_by(cls.id).limit(chunk_size)).all()
+        if not rows:
+            return
+        yield from rows
+        after_id = rows[-1][0]
+
+
+class MemoryBackend(SearchBackend):
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot
+        self.indexes = {}
+        self._saved = None
+        self._lock = threading.Lock()
+        if snapshot:
+            atexit.register(self.save)
+
+    def _build(self, name):
+        if self._saved is None:
+            self._saved = {}
+            if self.snapshot and os.path.exists(self.snapshot):
+                with open(self.snapshot, 'rb') as f:
+                    self._saved = pickle.load(f)
+        index = self._saved.pop(name, None) or InvertedIndex()
+        from app.indexing import searchable_models
+        cls = searchable_models()[name]
+        # cập nhật phần thay đổi từ lúc lưu snapshot: bài bị xoá và bài mới
+        # (bài được sửa thì không phát hiện được, cần chạy reindex)
+        ids = set(db.session.scalars(sa.select(cls.id)))
+        for doc in set(index.lengths) - ids:
+            index.remove(doc)
+        for row in _rows(cls, index.last_id):
+            index.add(row[0], row[1:])
+        return index
+
+    def _index(self, name):
+        index = self.indexes.get(name)
+        if index is None:
+            with self._lock:
+                if name not in self.indexes:
+                    self.indexes[name] = self._build(name)
+                index = self.indexes[name]
+        return index
+
+    def save(self):
+        """Lưu index xuống đĩa để lần khởi động sau không phải dựng lại."""
+        if not self.snapshot or not self.indexes:
+            return
+        tmp = f'{self.snapshot}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(self.indexes, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.snapshot)
+
+    def add(self, index, model):
+        self._index(index).add(
+            model.id, [getattr(model, f) for f in model.__searchable__])
+
+    def remove(self, index, model):
+        self._index(index).remove(model.id)
+
+    def commit(self, changes):
+        for name, id, op, payload in changes:
+            index = self.indexes.get(name)
+            if index is None:
+                # chưa dựng index, lúc dựng sẽ đọc dữ liệu mới từ database
+                continue
+            if op == 'index':
+                index.add(id, list(payload.values()))
+            else:
+                index.remove(id)
+        cache.bump(name for name, id, op, payload in changes)
+
+    def query(self, index, query, page, per_page):
+        scores = self._index(index).search(query)
+        top = heapq.nlargest(page * per_page, scores.items(),
+                             key=lambda item: (item[1], item[0]))
+        return [doc for doc, score in top[(page - 1) * per_page:]], \
+            len(scores)
+
+    def query_after(self, index, query, per_page, after):
+        items = self._index(index).search(query).items()
+        if after is not None:
+            after = tuple(after)
+            items = [(doc, score) for doc, score in items
+                     if (score, doc) < after]
+        top = heapq.nlargest(per_page + 1, items,
+                             key=lambda item: (item[1], item[0]))
+        last = [top[per_page - 1][1], top[per_page - 1][0]] \
+            if len(top) > per_page else None
+        return [doc for doc, score in top[:per_page]], last
+
+    def reindex(self, cls, progress=None, **kwargs):
+        index = InvertedIndex()
+        total = db.session.scalar(sa.select(sa.func.count()).select_from(cls))
+        done = 0
+        for row in _rows(cls, chunk_size=kwargs.get('chunk_size', 1000)):
+            index.add(row[0], row[1:])
+            done += 1
+            if progress and done % 1000 == 0:
+                progress(done, total)
+        self.indexes[cls.__tablename__] = index
+        cache.bump([cls.__tablename__])
+        self.save()
+        if progress:
+            progress(done, total)
+        return done, 0
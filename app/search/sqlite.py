@@ -0,0 +1,112 @@
+import sqlalchemy as sa
+from app import db
+from app.search import SearchBackend, cache
+
+# Mỗi index là 1 bảng ảo FTS5 tên search_<index>, rowid là id của object.
+# Bảng được cập nhật trong cùng transaction với thay đổi của object, và kết
+# quả được xếp hạng theo BM25.
+
+
+def _table(index):
+    return f'search_{index}'
+
+
+def _match(query):
+    # mỗi từ được đặt trong ngoặc kép để không bị hiểu là cú pháp FTS5,
+    # giống multi_match của Elasticsearch: chỉ cần khớp 1 từ
+    return ' OR '.join('"' + term.replace('"', '""') + '"'
+                       for term in query.split())
+
+
+class SQLiteBackend(SearchBackend):
+    def _create(self, connection, index, fields):
+        connection.execute(sa.text(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS {_table(index)} '
+            f'USING fts5({", ".join(fields)}, '
+            f'tokenize="unicode61 remove_diacritics 2")'))
+
+    def _exists(self, connection, index):
+        return connection.execute(sa.text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+            "AND name = :name"), {'name': _table(index)}).first() is not None
+
+    def add(self, index, model):
+        self.flush(db.session.connection(), [(model, 'index')])
+
+    def remove(self, index, model):
+        self.flush(db.session.connection(), [(model, 'delete')])
+
+    def flush(self, connection, changes):
+        indexes = {}
+        for obj, op in changes:
+            indexes.setdefault(obj.__tablename__, []).append((obj, op))
+        for index, objects in indexes.items():
+            fields = objects[0][0].__searchable__
+            table = _table(index)
+            self._create(connection, index, fields)
+            connection.execute(
+                sa.text(f'DELETE FROM {table} WHERE rowid = :id'),
+                [{'id': obj.id} for obj, op in objects])
+            rows = [{'id': obj.id, **{f: getattr(obj, f) for f in fields}}
+                    for obj, op in objects if op == 'index']
+            if rows:
+                connection.execute(sa.text(
+                    f'INSERT INTO {table} (rowid, {", ".join(fields)}) '
+                    f'VALUES (:id, {", ".join(":" + f for f in fields)})'),
+                    rows)
+
+    def commit(self, changes):
+        cache.bump(index for index, id, op, payload in changes)
+
+    def query(self, index, query, page, per_page):
+        match = _match(query)
+        connection = db.session.connection()
+        if not match or not self._exists(connection, index):
+            return [], 0
+        table = _table(index)
+        ids = connection.execute(sa.text(
+            f'SELECT rowid FROM {table} WHERE {table} MATCH :match '
+            f'ORDER BY bm25({table}), rowid DESC LIMIT :limit OFFSET :offset'),
+            {'match': match, 'limit': per_page,
+             'offset': (page - 1) * per_page}).scalars().all()
+        total = connection.execute(sa.text(
+            f'SELECT count(*) FROM {table} WHERE {table} MATCH :match'),
+            {'match': match}).scalar()
+        return ids, total
+
+    def query_after(self, index, query, per_page, after):
+        match = _match(query)
+        connection = db.session.connection()
+        if not match or not self._exists(connection, index):
+            return [], None
+        table = _table(index)
+        # bm25 càng nhỏ càng khớp, nên "sau" nghĩa là điểm lớn hơn
+        rows = connection.execute(sa.text(
+            f'SELECT rowid, score FROM (SELECT rowid, bm25({table}) AS score '
+            f'FROM {table} WHERE {table} MATCH :match) '
+            f'WHERE :first OR score > :score '
+            f'OR (score = :score AND rowid < :id) '
+            f'ORDER BY score, rowid DESC LIMIT :limit'),
+            {'match': match, 'first': after is None,
+             'score': -after[0] if after else 0, 'id': after[1] if after else 0,
+             'limit': per_page + 1}).all()
+        last = [-rows[per_page - 1][1], rows[per_page - 1][0]] \
+            if len(rows) > per_page else None
+        return [row[0] for row in rows[:per_page]], last
+
+    def reindex(self, cls, progress=None, **kwargs):
+        index = cls.__tablename__
+        table = _table(index)
+        fields = ', '.join(cls.__searchable__)
+        with db.engine.begin() as connection:
+            self._create(connection, index, cls.__searchable__)
+            connection.execute(sa.text(f'DELETE FROM {table}'))
+            total = connection.execute(sa.text(
+                f'INSERT INTO {table} (rowid, {fields}) '
+                f'SELECT id, {fields} FROM "{cls.__table__.name}"')).rowcount
+            connection.execute(sa.text(
+                f"INSERT INTO {table} ({table}) VALUES ('optimize')"))
+        cache.bump([index])
+        if progress:
+            progress(total, total)
+        return total, 0
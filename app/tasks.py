@@ -1,11 +1,11 @@
-import json
+from datetime import datetime, timezone
+import os
 import sys
-import time
-import sqlalchemy as sa
-from flask import render_template
+from flask import render_template, url_for
+import redis
 from rq import get_current_job
-from app import create_app, db
-from app.models import User, Post, Task
+from app import create_app, db, export, progress as task_progress, queues
+from app.models import User, Task
 from app.email import send_email
 
 app = create_app()
@@ -15,43 +15,77 @@ app.app_context().push()
 def _set_task_progress(progress):
     job = get_current_job()
     if job:
-        job.meta['progress'] = progress
-        job.save_meta()
+        # job của launch_task luôn nhận user_id là tham số đầu tiên
+        user_id = job.args[0]
+        if 0 < progress < 100:
+            # tiến độ giữa chừng chỉ nằm trong Redis
+            task_progress.update(job.get_id(), user_id, progress)
+            return
+        task_progress.update(job.get_id(), user_id, progress, force=True)
         task = db.session.get(Task, job.get_id())
-        task.user.add_notification('task_progress', {'task_id': job.get_id(),
-                                                     'progress': progress})
+        task.user.add_notification(
+            'task_progress', {'task_id': job.get_id(), 'progress': progress})
         if progress >= 100:
             task.complete = True
         db.session.commit()
+        if progress >= 100:
+            try:
+                queues.release_lock(user_id, task.name, job.get_id())
+            except redis.exceptions.RedisError:
+                # khoá tự hết hạn, launch_task cũng bỏ qua khoá của task đã xong
+                pass
 
 
-def export_posts(user_id):
+def export_posts(user_id, fmt='ndjson', base_url='http://localhost/'):
+    job = get_current_job()
     try:
         user = db.session.get(User, user_id)
         _set_task_progress(0)
-        data = []
-        i = 0
-        total_posts = db.session.scalar(sa.select(sa.func.count()).select_from(
-            user.posts.select().subquery()))
-        for post in db.session.scalars(user.posts.select().order_by(
-                Post.timestamp.asc())):
-            data.append({'body': post.body,
-                         'timestamp': post.timestamp.isoformat() + 'Z'})
-            time.sleep(5)
-            i += 1
-            _set_task_progress(100 * i // total_posts)
-
-        send_email(
-            '[Microblog] Your blog posts',
-            sender=app.config['ADMINS'][0], recipients=[user.email],
-            text_body=render_template('email/export_posts.txt', user=user),
-            html_body=render_template('email/export_posts.html', user=user),
-            attachments=[('posts.json', 'application/json',
-                          json.dumps({'posts': data}, indent=4))],
-            sync=True
-        )
+        key = job.get_id() if job else f'export-{user_id}'
+        # cùng job chạy lại (Retry) thì dùng lại file và checkpoint
+        path = app.artifacts.path(user_id, key, export.export_filename(fmt))
+        export.export_posts(
+            user, path, fmt, chunk_size=app.config['EXPORT_CHUNK_SIZE'],
+            progress=lambda done, total: _set_task_progress(
+                min(100 * done // total, 99)))
+
+        # worker không có request, link được tạo theo địa chỉ của trang web
+        # lúc người dùng yêu cầu
+        with app.test_request_context(base_url=base_url):
+            url = url_for('main.download_export', task_id=key, _external=True)
+            expires = datetime.fromtimestamp(app.artifacts.expires_at(
+                os.path.dirname(path)), timezone.utc)
+            send_email(
+                '[Microblog] Your blog posts',
+                sender=app.config['ADMINS'][0], recipients=[user.email],
+                text_body=render_template('email/export_posts.txt', user=user,
+                                          url=url, expires=expires),
+                html_body=render_template('email/export_posts.html', user=user,
+                                          url=url, expires=expires),
+                sync=True
+            )
+    except Exception:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+        db.session.rollback()
+        # rq chạy lại job nếu còn lượt; task chỉ kết thúc ở lần thử cuối
+        if job is None or not job.retries_left:
+            _set_task_progress(100)
+        raise
+    _set_task_progress(100)
+
+
+def cleanup_artifacts(interval=None):
+    """Xoá artifact hết hạn; nếu có `interval` thì tự hẹn chạy lại sau
+    `interval` giây (worker cần chạy với --with-scheduler)."""
+    try:
+        removed = app.artifacts.cleanup()
+        app.logger.info('Removed %d expired artifacts', removed)
     except Exception:
-        _set_task_progress(100)
         app.logger.error('Unhandled exception', exc_info=sys.exc_info())
     finally:
-        _set_task_progress(100)
+        job = get_current_job()
+        # chuỗi job thừa (lệnh hẹn chạy nhiều lần trước đây) dừng ở đây
+        if interval and queues.scheduled_job_id('cleanup_artifacts') in (
+                None, job.get_id() if job else None):
+            queues.schedule_periodic('cleanup_artifacts', interval,
+                                     delay=interval)
@@ -0,0 +1,213 @@
+from datetime import timezone
+import heapq
+import redis
+from flask import current_app
+
+# Mỗi user có 1 sorted set trong Redis chứa id các bài post trên trang chủ,
+# score là timestamp của bài post. Bài mới được đẩy vào (fan-out) khi commit,
+# nên trang chủ chỉ cần đọc đúng 1 trang id thay vì join toàn bộ bảng post.
+# Riêng tác giả có quá nhiều người theo dõi (TIMELINE_FANOUT_THRESHOLD) thì
+# không fan-out, bài của họ nằm trong danh sách riêng và được trộn lúc đọc.
+
+# chỉ thêm vào timeline đã có sẵn, timeline chưa có sẽ được dựng lại khi đọc
+_ADD_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    for i = 2, #ARGV, 2 do
+        redis.call('zadd', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    redis.call('zremrangebyrank', KEYS[1], 0, -tonumber(ARGV[1]) - 1)
+end
+"""
+
+
+def _key(user_id):
+    return f'timeline:{user_id}'
+
+
+def _author_key(author_id):
+    return f'timeline-author:{author_id}'
+
+
+_CELEBRITIES_KEY = 'timeline-celebrities'
+
+
+def score(timestamp):
+    return timestamp.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _add_args(posts):
+    args = [current_app.config['TIMELINE_LENGTH']]
+    for post_id, timestamp in posts:
+        args.extend([score(timestamp), post_id])
+    return args
+
+
+def push_post(user_ids, post_id, timestamp):
+    """Đẩy 1 bài post mới vào timeline của các user."""
+    script = current_app.redis.register_script(_ADD_SCRIPT)
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            script(keys=[_key(user_id)],
+                   args=_add_args([(post_id, timestamp)]), client=pipe)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        pass
+
+
+def add_posts(user_id, posts):
+    """Gộp các bài post (id, timestamp) vào timeline của user, vd khi follow."""
+    if not posts:
+        return
+    script = current_app.redis.register_script(_ADD_SCRIPT)
+    try:
+        script(keys=[_key(user_id)], args=_add_args(posts))
+    except redis.exceptions.RedisError:
+        pass
+
+
+def rebuild(user_id, posts):
+    """Dựng lại timeline của user từ kết quả truy vấn SQL."""
+    if not posts:
+        return
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.delete(_key(user_id))
+        pipe.zadd(_key(user_id), {str(post_id): score(timestamp)
+                                  for post_id, timestamp in posts})
+        pipe.zremrangebyrank(_key(user_id), 0,
+                             -current_app.config['TIMELINE_LENGTH'] - 1)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        pass
+
+
+def push_author_posts(author_id, posts):
+    """Lưu các bài post (id, timestamp) của tác giả không fan-out vào danh
+    sách bài gần đây."""
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.zadd(_author_key(author_id), {str(post_id): score(timestamp)
+                                           for post_id, timestamp in posts})
+        pipe.zremrangebyrank(_author_key(author_id), 0,
+                             -current_app.config['TIMELINE_LENGTH'] - 1)
+        pipe.sadd(_CELEBRITIES_KEY, author_id)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        pass
+
+
+def celebrities():
+    """Id các tác giả có bài được trộn lúc đọc thay vì fan-out."""
+    try:
+        return {int(i) for i in current_app.redis.smembers(_CELEBRITIES_KEY)}
+    except redis.exceptions.RedisError:
+        return set()
+
+
+def invalidate(user_id):
+    try:
+        current_app.redis.delete(_key(user_id))
+    except redis.exceptions.RedisError:
+        pass
+
+
+def _keys(user_id, authors):
+    return [_key(user_id)] + [_author_key(a) for a in sorted(authors)]
+
+
+def _merge(lists, reverse):
+    # k-way merge các danh sách đã sắp xếp, bỏ bài trùng
+    merged = []
+    seen = set()
+    lists = [sorted(entries, reverse=reverse) for entries in lists]
+    for entry in heapq.merge(*lists, reverse=reverse):
+        if entry[1] not in seen:
+            seen.add(entry[1])
+            merged.append(entry)
+    return merged
+
+
+def _entries(result):
+    return [(s, int(member)) for member, s in result]
+
+
+def get_page(user_id, page, per_page, authors=()):
+    """Trả về (ids, total) của 1 trang, hoặc None nếu timeline chưa có.
+
+    `authors` là các tác giả không fan-out mà user đang theo dõi, bài của họ
+    được trộn vào timeline lúc đọc."""
+    keys = _keys(user_id, authors)
+    end = page * per_page
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.zcard(key)
+            pipe.zrevrange(key, 0, end, withscores=True)
+        results = pipe.execute()
+    except redis.exceptions.RedisError:
+        return None
+    cards, lists = results[0::2], results[1::2]
+    if cards[0] == 0:
+        return None
+    for card in cards:
+        if card >= current_app.config['TIMELINE_LENGTH'] and end >= card:
+            # trang nằm ngoài phần được cache, phải đọc từ database
+            return None
+    entries = _merge([_entries(entries) for entries in lists], reverse=True)
+    # total chỉ đủ để biết còn trang sau hay không
+    return [post_id for s, post_id in entries[end - per_page:end]], \
+        len(entries)
+
+
+def get_cursor_page(user_id, per_page, before=None, after=None, authors=()):
+    """Trả về (ids, has_next, has_prev) của trang nằm trước `before` hoặc sau
+    `after` (cặp (timestamp, id)), hoặc None nếu phải đọc từ database."""
+    keys = _keys(user_id, authors)
+    cursor = after or before
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.zcard(key)
+            if cursor is not None:
+                # các bài trùng timestamp với con trỏ được lọc theo id bên dưới
+                pipe.zcount(key, score(cursor[0]), score(cursor[0]))
+        counts = pipe.execute()
+        step = 2 if cursor is not None else 1
+        cards = counts[0::step]
+        ties = counts[1::step] if cursor is not None else [0] * len(keys)
+        if cards[0] == 0:
+            return None
+        pipe = current_app.redis.pipeline(transaction=False)
+        for key, tie in zip(keys, ties):
+            if after is not None:
+                pipe.zrangebyscore(key, score(after[0]), '+inf', start=0,
+                                   num=per_page + 1 + tie, withscores=True)
+            else:
+                pipe.zrevrangebyscore(
+                    key, score(before[0]) if before is not None else '+inf',
+                    '-inf', start=0, num=per_page + 1 + tie, withscores=True)
+        lists = pipe.execute()
+    except redis.exceptions.RedisError:
+        return None
+    for card, tie, entries in zip(cards, ties, lists):
+        if after is None and card >= current_app.config['TIMELINE_LENGTH'] \
+                and len(entries) < per_page + 1 + tie:
+            # đã đọc hết phần được cache, bài cũ hơn phải lấy từ database
+            return None
+    if after is not None:
+        entries = [e for e in _merge([_entries(e) for e in lists],
+                                     reverse=False)
+                   if e > (score(after[0]), after[1])]
+        has_prev = len(entries) > per_page
+        entries = list(reversed(entries[:per_page]))
+        has_next = True
+    else:
+        entries = _merge([_entries(e) for e in lists], reverse=True)
+        if before is not None:
+            entries = [e for e in entries
+                       if e < (score(before[0]), before[1])]
+        has_next = len(entries) > per_page
+        entries = entries[:per_page]
+        has_prev = before is not None
+    return [post_id for s, post_id in entries], has_next, has_prev
@@ -15,6 +15,20 @@ class Config(object):
 
     # Tìm kiếm bài post
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # 'elasticsearch', 'sqlite', 'memory' hoặc 'none', để trống thì tự chọn
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+    # Cache kết quả tìm kiếm trong mỗi process, SEARCH_CACHE_SIZE=0 để tắt
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 1000)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 60)
+    # file lưu index của backend 'memory' để khởi động lại nhanh
+    SEARCH_MEMORY_SNAPSHOT = os.environ.get('SEARCH_MEMORY_SNAPSHOT')
+
+    # Hàng đợi cập nhật index: số document mỗi lô bulk, số lần thử lại trước
+    # khi chuyển vào dead-letter và thời gian chờ (giây) cho lần thử đầu
+    SEARCH_QUEUE_BATCH_SIZE = int(os.environ.get('SEARCH_QUEUE_BATCH_SIZE') or 500)
+    SEARCH_QUEUE_MAX_ATTEMPTS = int(
+        os.environ.get('SEARCH_QUEUE_MAX_ATTEMPTS') or 5)
+    SEARCH_QUEUE_RETRY_DELAY = int(os.environ.get('SEARCH_QUEUE_RETRY_DELAY') or 2)
 
     # Gửi lỗi qua em
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
@@ -27,4 +41,72 @@ class Config(object):
     # Số lượng bài post trên 1 trang
     POSTS_PER_PAGE = 10
 
-    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
\ No newline at end of file
+    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+
+    # File do task nền tạo ra (vd. file xuất bài post) nằm trong ARTIFACT_DIR
+    # và bị xoá sau ARTIFACT_RETENTION giây; người dùng tải về qua link
+    ARTIFACT_DIR = os.environ.get('ARTIFACT_DIR') or \
+        os.path.join(basedir, 'artifacts')
+    ARTIFACT_RETENTION = int(
+        os.environ.get('ARTIFACT_RETENTION') or 7 * 24 * 3600)
+
+    # Số bài post đọc mỗi lô khi xuất bài post; job lỗi (hoặc worker chết)
+    # được chạy lại tối đa EXPORT_RETRIES lần, tiếp tục từ checkpoint, cách
+    # nhau EXPORT_RETRY_INTERVAL giây
+    EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE') or 1000)
+    EXPORT_RETRIES = int(os.environ.get('EXPORT_RETRIES') or 3)
+    EXPORT_RETRY_INTERVAL = int(os.environ.get('EXPORT_RETRY_INTERVAL') or 60)
+
+    # Hàng đợi task nền theo thứ tự ưu tiên và hàng đợi của từng task (task
+    # không có trong TASK_ROUTES vào 'default'). TASK_WORKERS là số process
+    # worker của mỗi hàng đợi khi chạy `flask tasks worker`.
+    TASK_QUEUES = ['high', 'default', 'bulk']
+    TASK_ROUTES = {'export_posts': 'bulk', 'cleanup_artifacts': 'bulk'}
+    TASK_WORKERS = os.environ.get('TASK_WORKERS') or 'high=1,default=2,bulk=1'
+    # Khoá chống chạy trùng task của 1 user tự hết hạn sau TASK_LOCK_TTL giây
+    TASK_LOCK_TTL = int(os.environ.get('TASK_LOCK_TTL') or 3600)
+
+    # Tiến độ của mỗi task nền được cập nhật nhiều nhất TASK_PROGRESS_RATE
+    # lần/giây (chỉ trong Redis)
+    TASK_PROGRESS_RATE = float(os.environ.get('TASK_PROGRESS_RATE') or 2)
+
+    # last_seen chỉ được cập nhật khi cũ hơn LAST_SEEN_GRANULARITY giây, và
+    # được ghi xuống database theo lô mỗi LAST_SEEN_FLUSH_INTERVAL giây
+    LAST_SEEN_GRANULARITY = int(os.environ.get('LAST_SEEN_GRANULARITY') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(
+        os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 60)
+
+    # Cache user cho Flask-Login: LRU trong mỗi process, có thể thêm Redis
+    USER_CACHE_ENABLED = os.environ.get('USER_CACHE_DISABLED') is None
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 10000)
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 30)
+    USER_CACHE_REDIS = os.environ.get('USER_CACHE_REDIS') is not None
+
+    # Cache token API đã xác thực (theo hash của token), bị xoá trên mọi
+    # process qua Redis pub/sub khi token bị thu hồi
+    TOKEN_CACHE_ENABLED = os.environ.get('TOKEN_CACHE_DISABLED') is None
+    TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE') or 10000)
+    TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL') or 300)
+
+    # Loại token của API: 'opaque' (lưu trong bảng user) hoặc 'jwt' (token
+    # ký bằng SECRET_KEY, ngắn hạn, kiểm tra không cần database). Cả hai loại
+    # đều được chấp nhận khi xác thực để có thể chuyển dần.
+    API_TOKEN_MODE = os.environ.get('API_TOKEN_MODE') or 'opaque'
+    API_TOKEN_EXPIRES_IN = int(os.environ.get('API_TOKEN_EXPIRES_IN') or 900)
+    # Số jti bị thu hồi tối đa giữ trong bộ nhớ của mỗi process
+    API_TOKEN_REVOCATION_SIZE = int(
+        os.environ.get('API_TOKEN_REVOCATION_SIZE') or 100000)
+
+    # Kết nối SSE /notifications/stream được đóng sau
+    # NOTIFICATIONS_STREAM_TIMEOUT giây (trình duyệt tự kết nối lại), và gửi
+    # keepalive mỗi NOTIFICATIONS_KEEPALIVE giây khi không có thông báo
+    NOTIFICATIONS_STREAM_TIMEOUT = int(
+        os.environ.get('NOTIFICATIONS_STREAM_TIMEOUT') or 300)
+    NOTIFICATIONS_KEEPALIVE = int(os.environ.get('NOTIFICATIONS_KEEPALIVE') or 15)
+
+    # Số bài post tối đa giữ trong timeline trang chủ (Redis) của mỗi user
+    TIMELINE_LENGTH = int(os.environ.get('TIMELINE_LENGTH') or 800)
+    # Tác giả có nhiều người theo dõi hơn ngưỡng này thì không fan-out bài
+    # viết, bài của họ được trộn vào timeline lúc đọc
+    TIMELINE_FANOUT_THRESHOLD = int(
+        os.environ.get('TIMELINE_FANOUT_THRESHOLD') or 10000)
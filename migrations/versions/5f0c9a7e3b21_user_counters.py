@@ -0,0 +1,39 @@
+"""user counters
+
+Revision ID: 5f0c9a7e3b21
+Revises: 449fdfb2b6af
+Create Date: 2026-10-18 10:12:31.402118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f0c9a7e3b21'
+down_revision = '449fdfb2b6af'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('num_posts', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('num_followers', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('num_following', sa.Integer(), server_default='0', nullable=False))
+
+    # điền giá trị ban đầu cho các bộ đếm
+    op.execute('UPDATE "user" SET '
+               'num_posts = (SELECT COUNT(*) FROM post '
+               'WHERE post.user_id = "user".id), '
+               'num_followers = (SELECT COUNT(*) FROM followers '
+               'WHERE followers.followed_id = "user".id), '
+               'num_following = (SELECT COUNT(*) FROM followers '
+               'WHERE followers.follower_id = "user".id)')
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('num_following')
+        batch_op.drop_column('num_followers')
+        batch_op.drop_column('num_posts')
@@ -0,0 +1,33 @@
+"""unread message counter
+
+Revision ID: 7b1e5d9c2a64
+Revises: c4d2e8a1f7b3
+Create Date: 2026-10-18 19:40:27.093118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b1e5d9c2a64'
+down_revision = 'c4d2e8a1f7b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('num_unread_messages', sa.Integer(), server_default='0', nullable=False))
+
+    # điền giá trị ban đầu cho bộ đếm
+    op.execute('UPDATE "user" SET '
+               'num_unread_messages = (SELECT COUNT(*) FROM message '
+               'WHERE message.recipient_id = "user".id AND '
+               'message.timestamp > COALESCE("user".last_message_read_time, '
+               "'1900-01-01'))")
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('num_unread_messages')
@@ -0,0 +1,33 @@
+"""unique notification name per user
+
+Revision ID: c4d2e8a1f7b3
+Revises: 5f0c9a7e3b21
+Create Date: 2026-10-18 19:05:12.518304
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d2e8a1f7b3'
+down_revision = '5f0c9a7e3b21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # chỉ giữ thông báo mới nhất của mỗi (user_id, name); bảng con (derived
+    # table) vì MySQL không cho DELETE đọc chính bảng đó trong subquery
+    op.execute('DELETE FROM notification WHERE id NOT IN '
+               '(SELECT id FROM (SELECT MAX(id) AS id FROM notification '
+               'GROUP BY user_id, name) AS latest)')
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_notification_user_id_name',
+                                          ['user_id', 'name'])
+
+
+def downgrade():
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_notification_user_id_name',
+                                 type_='unique')
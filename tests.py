@@ -2,10 +2,29 @@
 
 # UNIT TESTING
 
+from contextlib import contextmanager
 from datetime import datetime, timezone, timedelta
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
-from app import create_app, db
-from app.models import User, Post
+from unittest import mock
+import fakeredis
+import rq
+from flask_login import FlaskLoginClient
+import sqlalchemy as sa
+from app import create_app, db, mail
+from app.export import export_posts
+from app.models import User, Post, Message, Notification, Task
+from app import indexing, notifications
+from app.indexing import collapse
+from app.pagination import paginate_cursor, encode_cursor, cursor_values
+from app.queues import get_queue, parse_pools, scheduled_job_id
+from app.search.cache import SearchCache
+from app.search.memory import InvertedIndex
 from config import Config
 
 # Setup môi trường data ảo
@@ -105,6 +124,996 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    @contextmanager
+    def count_queries(self, engine):
+        queries = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            queries.append(statement)
+
+        sa.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield queries
+        finally:
+            sa.event.remove(engine, 'before_cursor_execute',
+                            before_cursor_execute)
+
+    def test_list_view_queries(self):
+        # số query của 1 trang có giới hạn và không tăng theo số bài post
+        users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                 for i in range(10)]
+        db.session.add_all(users)
+        db.session.add_all([Post(body=f'post {i}', author=users[i % 10])
+                            for i in range(30)])
+        db.session.commit()
+        for u in users[1:]:
+            users[0].follow(u)
+        db.session.commit()
+
+        self.app.test_client_class = FlaskLoginClient
+        client = self.app.test_client(user=users[0])
+        engine = db.engine
+        counts = {}
+        # mỗi request tự tạo app context và session riêng như khi chạy thật
+        self.app_context.pop()
+        try:
+            for per_page in [5, 25]:
+                self.app.config['POSTS_PER_PAGE'] = per_page
+                for url in ['/explore', '/index', '/index?page=1']:
+                    with self.count_queries(engine) as queries:
+                        response = client.get(url)
+                    self.assertEqual(response.status_code, 200)
+                    self.assertLessEqual(len(queries), 10, url)
+                    counts.setdefault(url, []).append(len(queries))
+        finally:
+            self.app_context.push()
+        for url, (small, large) in counts.items():
+            self.assertLessEqual(large, small, url)
+
+    def test_last_seen_tracker(self):
+        tracker = self.app.last_seen_tracker
+        old = datetime(2020, 1, 1)
+        u = User(username='john', email='john@example.com', last_seen=old)
+        db.session.add(u)
+        db.session.commit()
+
+        tracker.record(u)
+        self.assertEqual(tracker.flush(), 0)
+        self.assertEqual(u.last_seen, old)
+        self.assertEqual(tracker.flush(force=True), 1)
+        self.assertGreater(u.last_seen, old)
+
+        # vừa cập nhật xong thì không ghi nhận lại
+        tracker.record(u)
+        self.assertEqual(tracker.flush(force=True), 0)
+
+        # database lỗi: giá trị được giữ lại cho lần ghi sau
+        u.last_seen = old
+        db.session.commit()
+        tracker.record(u)
+        error = sa.exc.OperationalError('UPDATE user', {}, None)
+        with mock.patch.object(db.session, 'execute', side_effect=error):
+            self.assertEqual(tracker.flush(force=True), 0)
+        self.assertEqual(u.last_seen, old)
+        # process kết thúc thì ghi nốt
+        tracker._flush_at_exit(self.app)
+        db.session.refresh(u)
+        self.assertGreater(u.last_seen, old)
+
+    def test_user_cache(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        User.get_cached(u.id)
+        db.session.remove()
+
+        with self.count_queries(db.engine) as queries:
+            cached = User.get_cached(u.id)
+            self.assertEqual(cached.username, 'john')
+        self.assertEqual(queries, [])
+
+        # sửa profile thì user bị xoá khỏi cache
+        cached.about_me = 'hello'
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual(User.get_cached(u.id).about_me, 'hello')
+        self.assertEqual(self.app.user_cache.stats()['hits'], 1)
+
+    def test_revoke_token(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        token = u.get_token()
+        db.session.commit()
+        self.assertEqual(User.check_token(token), u)
+        u.revoke_token()
+        db.session.commit()
+        self.assertIsNone(User.check_token(token))
+
+    def test_signed_token(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        token = u.get_signed_token()
+        self.assertEqual(User.check_signed_token(token), u)
+        self.assertIsNone(User.check_signed_token(token + 'x'))
+        self.assertIsNone(User.check_signed_token(u.get_signed_token(-10)))
+        User.revoke_signed_token(token)
+        self.assertIsNone(User.check_signed_token(token))
+        self.assertEqual(User.check_signed_token(u.get_signed_token()), u)
+
+    def test_collapse_index_changes(self):
+        entries = [{'index': 'post', 'id': 1, 'op': 'index'},
+                   {'index': 'post', 'id': 2, 'op': 'index'},
+                   {'index': 'post', 'id': 1, 'op': 'index'},
+                   {'index': 'post', 'id': 2, 'op': 'delete'}]
+        self.assertEqual([(e['id'], e['op']) for e in collapse(entries)],
+                         [(1, 'index'), (2, 'delete')])
+
+    def test_search(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the quick brown fox', author=u)
+        p2 = Post(body='a lazy brown dog', author=u)
+        p3 = Post(body='hello world', author=u)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+        posts, total = Post.search('quick brown', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual(list(posts), [p1, p2])
+
+        p1.body = 'hello again'
+        db.session.delete(p2)
+        db.session.commit()
+        posts, total = Post.search('hello', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual(set(posts), {p1, p3})
+        self.assertEqual(Post.search('brown', 1, 10), ([], 0))
+
+    def test_search_change_tracking(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(body='hello', author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+        changes = []
+        self.app.search_backend.commit = changes.extend
+        p.language = 'en'
+        db.session.commit()
+        self.assertEqual(changes, [])
+        p.body = 'goodbye'
+        db.session.commit()
+        self.assertEqual(changes,
+                         [('post', p.id, 'index', {'body': 'goodbye'})])
+
+    def test_search_cursor(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.add_all([Post(body='apple ' * (i % 3 + 1) + 'pie',
+                                 author=u) for i in range(7)])
+        db.session.commit()
+        posts, total = Post.search('apple', 1, 10)
+        expected = list(posts)
+        found = []
+        cursor = None
+        while True:
+            posts, cursor = Post.search_cursor('apple', 3, cursor)
+            found += posts
+            if cursor is None:
+                break
+        self.assertEqual(found, expected)
+
+    def test_inverted_index(self):
+        index = InvertedIndex()
+        index.add(3, ['the quick brown fox'])
+        index.add(1, ['brown is a quick colour'])
+        index.add(2, ['Quá nhanh'])
+        self.assertEqual(set(index.search('quick')), {1, 3})
+        self.assertEqual(set(index.search('"quick brown"')), {3})
+        self.assertEqual(set(index.search('col*')), {1})
+        self.assertEqual(set(index.search('qua')), {2})
+        scores = index.search('fox brown')
+        self.assertGreater(scores[3], scores[1])
+
+        index.remove(3)
+        index.add(1, ['something else'])
+        self.assertEqual(index.search('quick'), {})
+        self.assertEqual(set(index.search('else')), {1})
+
+    def test_add_notification(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        # các lần gọi trước khi commit được gộp thành 1 lệnh ghi và 1 lần gửi
+        with self.count_queries(db.engine) as queries, \
+                mock.patch('app.notifications.publish') as publish:
+            for i in range(1, 4):
+                u.add_notification('unread_message_count', i)
+            db.session.commit()
+        self.assertEqual(len([q for q in queries
+                              if 'notification' in q.lower()]), 1)
+        publish.assert_called_once()
+        notifications = db.session.scalars(u.notifications.select()).all()
+        self.assertEqual([n.get_data() for n in notifications], [3])
+
+        # giá trị ghi sau cùng được giữ, kể cả qua nhiều lần commit
+        u.add_notification('task_progress', 10)
+        db.session.commit()
+        n = db.session.scalar(u.notifications.select().where(
+            Notification.name == 'task_progress'))
+        u.add_notification('task_progress', 20)
+        u.add_notification('task_progress', 100)
+        db.session.commit()
+        db.session.refresh(n)
+        self.assertEqual(n.get_data(), 100)
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(
+            u.notifications.select().subquery())), 2)
+
+    def test_posts_count(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.add_all([Post(body='post 1', author=u1),
+                            Post(body='post 2', author=u1)])
+        db.session.commit()
+        self.assertEqual(u1.posts_count(), 2)
+        self.assertEqual(u2.posts_count(), 0)
+
+        db.session.add(Post(body='post 3', author=u2))
+        db.session.commit()
+        self.assertEqual(u2.posts_count(), 1)
+
+    def test_unread_message_count(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.add_all([Message(author=u1, recipient=u2, body='hi'),
+                            Message(author=u1, recipient=u2, body='hello')])
+        db.session.commit()
+        self.assertEqual(u2.unread_message_count(), 2)
+        self.assertEqual(u1.unread_message_count(), 0)
+
+        u2.mark_messages_read()
+        db.session.commit()
+        self.assertEqual(u2.unread_message_count(), 0)
+        db.session.add(Message(author=u1, recipient=u2, body='again'))
+        db.session.commit()
+        self.assertEqual(u2.unread_message_count(), 1)
+
+    def test_cursor_pagination(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        # 2 bài cùng timestamp để kiểm tra thứ tự theo id
+        posts = [Post(body=f'post {i}', author=u,
+                      timestamp=now + timedelta(seconds=min(i, 3)))
+                 for i in range(5)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        expected = sorted(posts, key=lambda p: (p.timestamp, p.id),
+                          reverse=True)
+
+        columns = Post.cursor_columns()
+        page1 = paginate_cursor(sa.select(Post), columns, 2)
+        self.assertEqual(page1.items, expected[:2])
+        self.assertFalse(page1.has_prev)
+        page2 = paginate_cursor(sa.select(Post), columns, 2,
+                                before=page1.next_cursor)
+        self.assertEqual(page2.items, expected[2:4])
+        page3 = paginate_cursor(sa.select(Post), columns, 2,
+                                before=page2.next_cursor)
+        self.assertEqual(page3.items, expected[4:])
+        self.assertFalse(page3.has_next)
+        back = paginate_cursor(sa.select(Post), columns, 2,
+                               after=page3.prev_cursor)
+        self.assertEqual(back.items, expected[2:4])
+        self.assertTrue(back.has_prev)
+
+    def test_export_posts(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        db.session.add_all([u] + [
+            Post(body=f'post {i}', author=u,
+                 timestamp=now + timedelta(seconds=i)) for i in range(5)])
+        db.session.commit()
+        expected = [f'post {i}' for i in range(5)]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'posts.ndjson.gz')
+
+            # worker chết sau lô thứ 2, lần chạy sau tiếp tục từ checkpoint
+            def crash(done, total):
+                if done == 4:
+                    raise RuntimeError('worker died')
+            with self.assertRaises(RuntimeError):
+                export_posts(u, path, chunk_size=2, progress=crash)
+            reports = []
+            self.assertEqual(export_posts(
+                u, path, chunk_size=2,
+                progress=lambda done, total: reports.append(done)), 5)
+            self.assertEqual(reports, [5])
+            with gzip.open(path, 'rt') as f:
+                self.assertEqual([json.loads(line)['body'] for line in f],
+                                 expected)
+            self.assertFalse(os.path.exists(path + '.checkpoint'))
+
+            path = os.path.join(tmp, 'posts.json.gz')
+            export_posts(u, path, 'json', chunk_size=2)
+            with gzip.open(path, 'rt') as f:
+                self.assertEqual([p['body'] for p in json.load(f)['posts']],
+                                 expected)
+
+    def test_export_download(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            self.app.artifacts.root = tmp
+            path = self.app.artifacts.path(u1.id, 'job1', 'posts.ndjson.gz')
+            with open(path, 'wb') as f:
+                f.write(b'0123456789')
+            # file còn checkpoint thì chưa tải được
+            open(path + '.checkpoint', 'w').close()
+            self.assertIsNone(self.app.artifacts.get(u1.id, 'job1'))
+            os.remove(path + '.checkpoint')
+            self.assertIsNone(self.app.artifacts.get(u1.id, '../job1'))
+
+            self.app.test_client_class = FlaskLoginClient
+            owner = self.app.test_client(user=u1)
+            other = self.app.test_client(user=u2)
+            # mỗi request tự tạo app context riêng như khi chạy thật
+            self.app_context.pop()
+            try:
+                response = owner.get('/export_posts/job1',
+                                     headers={'Range': 'bytes=4-'})
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(response.data, b'456789')
+                response = other.get('/export_posts/job1')
+                self.assertEqual(response.status_code, 404)
+            finally:
+                self.app_context.push()
+
+            self.assertEqual(self.app.artifacts.cleanup(), 0)
+            self.assertEqual(self.app.artifacts.cleanup(
+                now=time.time() + self.app.artifacts.retention + 1), 1)
+            self.assertEqual(os.listdir(tmp), [])
+
+    def test_task_progress_without_redis(self):
+        u = User(username='john', email='john@example.com')
+        task = Task(id='job1', name='export_posts', user=u)
+        db.session.add(task)
+        db.session.commit()
+        # không có Redis thì chỉ biết task đã xong hay chưa
+        self.assertEqual(task.get_progress(), 0)
+        task.complete = True
+        self.assertEqual(task.get_progress(), 100)
+
+    def test_task_queues(self):
+        self.assertEqual(get_queue('export_posts').name, 'microblog-bulk')
+        self.assertEqual(get_queue('export_posts', 'high').name,
+                         'microblog-high')
+        # hàng đợi mặc định giữ tên cũ
+        self.assertEqual(get_queue('other').name, 'microblog-tasks')
+        with self.assertRaises(ValueError):
+            get_queue('other', 'nope')
+        self.assertEqual(parse_pools('high=2, default=3,bulk'),
+                         {'high': 2, 'default': 3, 'bulk': 1})
+
+
+
+class RedisModelCase(unittest.TestCase):
+    # các tính năng dùng Redis được chạy với fakeredis, mỗi test 1 server
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeRedis(server=self.server)
+        self.app = self.create_app()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def create_app(self):
+        # mỗi app giống 1 process web riêng, dùng chung server Redis
+        with mock.patch('app.Redis') as Redis:
+            Redis.from_url.return_value = fakeredis.FakeRedis(
+                server=self.server)
+            return create_app(TestConfig)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    count_queries = UserModelCase.count_queries
+
+    def wait_for(self, condition, timeout=2):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail('timed out')
+            time.sleep(0.01)
+
+    def start_listener(self, app):
+        app.revocation_listener.start()
+        self.wait_for(lambda: app.revocation_listener.connected)
+
+    def add_posts(self, author, count, start):
+        posts = [Post(body=f'{author.username} {i}', author=author,
+                      timestamp=start + timedelta(minutes=i))
+                 for i in range(count)]
+        db.session.add_all(posts)
+        db.session.commit()
+        return posts
+
+    def expected_timeline(self, user):
+        return db.session.scalars(user.following_posts()).all()
+
+    def test_user_cache_eviction(self):
+        self.app.config['USER_CACHE_REDIS'] = True
+        other = self.create_app()
+        other.config['USER_CACHE_REDIS'] = True
+        self.start_listener(self.app)
+        self.start_listener(other)
+        u = User(username='john', email='john@example.com',
+                 last_seen=datetime(2024, 1, 1))
+        db.session.add(u)
+        db.session.commit()
+        db.session.refresh(u)
+        with other.app_context():
+            User._cache_user(u)
+        self.assertIsNotNone(other.user_cache.get(u.id))
+        # tầng Redis lưu JSON, không dùng pickle
+        self.assertEqual(json.loads(self.redis.get(f'user-cache:{u.id}'))[
+            'username'], 'john')
+        db.session.remove()
+        with self.count_queries(db.engine) as queries:
+            cached = User.get_cached(u.id)
+        self.assertEqual(queries, [])
+        self.assertEqual(cached.last_seen, datetime(2024, 1, 1))
+
+        # sửa profile ở process này thì cache của process khác cũng bị xoá
+        cached.about_me = 'hello'
+        db.session.commit()
+        self.wait_for(lambda: other.user_cache.get(u.id) is None)
+        self.assertIsNone(self.app.user_cache.get(u.id))
+        self.assertIsNone(self.redis.get(f'user-cache:{u.id}'))
+        self.assertEqual(User.get_cached(u.id).about_me, 'hello')
+
+    def test_token_cache(self):
+        other = self.create_app()
+        self.start_listener(self.app)
+        self.start_listener(other)
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        token = u.get_token()
+        db.session.commit()
+        key = User._token_key(token)
+        self.assertEqual(User.check_token(token), u)
+        self.assertEqual(User.check_token(token), u)
+        other.token_cache.set(key, (u.id, u.token_expiration))
+        db.session.remove()
+
+        with self.count_queries(db.engine) as queries:
+            self.assertEqual(User.check_token(token).username, 'john')
+        self.assertEqual(queries, [])
+
+        # thu hồi token thì mọi process xoá token khỏi cache sau khi commit
+        u = db.session.get(User, u.id)
+        u.revoke_token()
+        self.assertIsNotNone(self.app.token_cache.get(key))
+        db.session.commit()
+        self.assertIsNone(self.app.token_cache.get(key))
+        self.wait_for(lambda: other.token_cache.get(key) is None)
+        self.assertIsNone(User.check_token(token))
+
+    def test_signed_token_revoked_in_other_process(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        token = u.get_signed_token()
+        User.revoke_signed_token(token)
+
+        jti = User._decode_signed_token(token)['jti']
+
+        # process mới: listener đồng bộ xong đúng lúc danh sách trong bộ nhớ
+        # vừa được đọc (lúc đó còn trống)
+        other = self.create_app()
+        listener = other.revocation_listener
+        revoked = other.revoked_tokens.get
+
+        def get(key):
+            result = revoked(key)
+            listener.connected = True
+            return result
+
+        with other.app_context(), \
+                mock.patch.object(listener, 'start'), \
+                mock.patch.object(other.revoked_tokens, 'get', get):
+            self.assertTrue(User._is_jti_revoked(jti))
+        listener.connected = False
+        self.start_listener(other)
+        with other.app_context():
+            self.assertTrue(User._is_jti_revoked(jti))
+
+    def test_revoked_tokens_overflow(self):
+        self.app.revoked_tokens.maxsize = 2
+        self.start_listener(self.app)
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        tokens = [u.get_signed_token() for i in range(3)]
+        for token in tokens:
+            User.revoke_signed_token(token)
+        # jti đầu tiên đã bị bỏ khỏi bộ nhớ, phải hỏi lại Redis
+        self.assertEqual(self.app.revoked_tokens.stats()['evictions'], 1)
+        for token in tokens:
+            self.assertIsNone(User.check_signed_token(token))
+        self.assertEqual(User.check_signed_token(u.get_signed_token()), u)
+
+    def test_reindex_replays_concurrent_changes(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u] + [Post(body=f'post {i}', author=u)
+                                  for i in range(3)])
+        db.session.commit()
+        self.app.elasticsearch = mock.MagicMock()
+        self.redis.delete(indexing.QUEUE_KEY)
+
+        def send_chunk(client, index, fields, rows):
+            # 1 bài được sửa trong lúc đang dựng index mới
+            with self.app.app_context():
+                indexing.enqueue([('post', rows[0][0], 'index')])
+            return len(rows), 0
+
+        with mock.patch('app.indexing._send_chunk', send_chunk):
+            self.assertEqual(indexing.reindex(Post, chunk_size=10), (3, 0))
+        # worker ghi thay đổi vào index cũ, rồi được gửi lại cho index mới
+        queued = [json.loads(item) for item in
+                  self.redis.lrange(indexing.QUEUE_KEY, 0, -1)]
+        self.assertEqual(queued, [{'index': 'post', 'id': 1, 'op': 'index'}] * 2)
+        self.assertEqual(self.redis.smembers(indexing.REINDEXING_KEY), set())
+        self.assertEqual(self.redis.exists('search-reindex-log:post'), 0)
+
+        # sau khi reindex xong thì không ghi log nữa
+        indexing.enqueue([('post', 2, 'delete')])
+        self.assertEqual(self.redis.llen(indexing.QUEUE_KEY), 3)
+
+    def test_search_queue_database_error(self):
+        self.app.elasticsearch = mock.MagicMock()
+        self.app.config['SEARCH_QUEUE_RETRY_DELAY'] = 0
+        self.redis.delete(indexing.QUEUE_KEY)
+        indexing.enqueue([('post', 1, 'index'), ('post', 2, 'delete')])
+        with mock.patch('app.indexing._actions',
+                        side_effect=sa.exc.OperationalError('', {}, None)):
+            self.assertEqual(indexing.process_batch(10), (0, 2))
+        # thay đổi không bị mất mà chờ thử lại
+        self.assertEqual(self.redis.llen(indexing.QUEUE_KEY), 0)
+        retries = [json.loads(item) for item in
+                   self.redis.zrange(indexing.RETRY_KEY, 0, -1)]
+        self.assertEqual(sorted((e['id'], e['attempts']) for e in retries),
+                         [(1, 1), (2, 1)])
+
+        def streaming_bulk(client, actions, **kwargs):
+            return [(True, {action['_op_type']: {}}) for action in actions]
+
+        with mock.patch('app.indexing.helpers.streaming_bulk',
+                        streaming_bulk):
+            self.assertEqual(indexing.process_batch(10), (2, 0))
+        self.assertEqual(self.redis.zcard(indexing.RETRY_KEY), 0)
+
+    def test_search_cache(self):
+        cache = self.app.search_cache.cache
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='hello world', author=u)
+        db.session.add_all([u, p1])
+        db.session.commit()
+        posts, total = Post.search('hello', 1, 10)
+        self.assertEqual((list(posts), total), ([p1], 1))
+        # cùng câu truy vấn (khác hoa thường, khoảng trắng) lấy từ cache
+        posts, total = Post.search('  HELLO ', 1, 10)
+        self.assertEqual((list(posts), total), ([p1], 1))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # commit thay đổi index thì số thế hệ tăng, kết quả cũ hết hiệu lực
+        p2 = Post(body='hello again', author=u)
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(int(self.redis.get('search-generation:post')), 2)
+        posts, total = Post.search('hello', 1, 10)
+        self.assertEqual((set(posts), total), ({p1, p2}, 2))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        # SEARCH_CACHE_SIZE=0 tắt cache
+        self.app.config['SEARCH_CACHE_SIZE'] = 0
+        disabled = SearchCache(self.app)
+        calls = []
+
+        def query(index, expression, page, per_page):
+            calls.append(expression)
+            return [], 0
+        disabled.query('post', 'hello', 1, 10, query)
+        disabled.query('post', 'hello', 1, 10, query)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(disabled.cache.stats()['size'], 0)
+
+    def sse_events(self, body):
+        return [json.loads(line[len('data: '):])
+                for line in body.decode('utf-8').splitlines()
+                if line.startswith('data: ')]
+
+    def test_notification_stream(self):
+        self.app.config['NOTIFICATIONS_STREAM_TIMEOUT'] = 0.5
+        self.app.config['NOTIFICATIONS_KEEPALIVE'] = 0.1
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        u.add_notification('first', 1)
+        db.session.commit()
+        since = db.session.scalar(u.notifications.select()).timestamp
+        u.add_notification('second', 2)
+        db.session.commit()
+        user_id = u.id
+        self.app.test_client_class = FlaskLoginClient
+        client = self.app.test_client(user=u)
+
+        def publish():
+            time.sleep(0.2)
+            with self.app.app_context():
+                user = db.session.get(User, user_id)
+                user.add_notification('live', 3)
+                db.session.commit()
+
+        # mỗi request tự tạo app context riêng như khi chạy thật
+        self.app_context.pop()
+        try:
+            # trình duyệt kết nối lại: chỉ phát lại thông báo sau Last-Event-ID
+            publisher = threading.Thread(target=publish)
+            publisher.start()
+            response = client.get('/notifications/stream',
+                                  headers={'Last-Event-ID': repr(since)})
+            body = response.get_data()
+            publisher.join()
+            self.assertEqual(response.mimetype, 'text/event-stream')
+            self.assertEqual([(n['name'], n['data'])
+                              for n in self.sse_events(body)],
+                             [('second', 2), ('live', 3)])
+            self.assertIn(b': keepalive', body)
+
+            response = client.get('/notifications/stream?since=0')
+            self.assertEqual([n['name'] for n in
+                              self.sse_events(response.get_data())],
+                             ['first', 'second', 'live'])
+
+            # không có Redis thì trình duyệt chuyển sang hỏi /notifications
+            self.server.connected = False
+            response = client.get('/notifications/stream')
+            self.assertEqual(response.status_code, 503)
+        finally:
+            self.server.connected = True
+            self.app_context.push()
+
+    def test_notifications_version(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        u.add_notification('first', 1)
+        db.session.commit()
+        first = db.session.scalar(u.notifications.select()).timestamp
+        key = f'notification-version:{u.id}'
+        self.assertLessEqual(self.redis.ttl(key), notifications.VERSION_TTL)
+        engine = db.engine
+        self.app.test_client_class = FlaskLoginClient
+        client = self.app.test_client(user=u)
+        anonymous = self.app.test_client()
+        self.app_context.pop()
+        try:
+            response = client.get('/notifications')
+            self.assertEqual([n['name'] for n in response.json], ['first'])
+            etag = response.headers['ETag']
+
+            # không có gì mới: trả lời chỉ bằng Redis, không truy vấn database
+            with self.count_queries(engine) as queries:
+                response = client.get('/notifications',
+                                      headers={'If-None-Match': etag})
+                self.assertEqual(response.status_code, 304)
+                response = client.get(f'/notifications?since={first!r}')
+                self.assertEqual(response.json, [])
+            self.assertEqual(queries, [])
+
+            # Redis gián đoạn lúc commit: phiên bản cũ bị xoá ở lần kết nối
+            # sau nên đọc lại từ database
+            self.server.connected = False
+            with self.app.app_context():
+                user = db.session.get(User, u.id)
+                user.add_notification('second', 2)
+                db.session.commit()
+            self.server.connected = True
+            response = client.get(f'/notifications?since={first!r}')
+            self.assertEqual([n['name'] for n in response.json], ['second'])
+            self.assertNotEqual(response.headers['ETag'], etag)
+            self.assertGreater(float(self.redis.get(key)), first)
+
+            response = anonymous.get('/notifications')
+            self.assertEqual(response.status_code, 302)
+        finally:
+            self.server.connected = True
+            self.app_context.push()
+
+    def import_tasks(self):
+        # app.tasks tạo app riêng lúc import (như trong worker); test dùng
+        # app của test thay cho app đó
+        with mock.patch('app.create_app'):
+            from app import tasks
+        return tasks
+
+    def test_export_task_retry(self):
+        self.app.config['EXPORT_CHUNK_SIZE'] = 2
+        self.app.config['EXPORT_RETRY_INTERVAL'] = 0
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        db.session.add_all([u] + [
+            Post(body=f'post {i}', author=u,
+                 timestamp=now + timedelta(seconds=i)) for i in range(5)])
+        db.session.commit()
+        self.app.test_client_class = FlaskLoginClient
+        client = self.app.test_client(user=u)
+        self.app_context.pop()
+        try:
+            client.get('/export_posts')
+        finally:
+            self.app_context.push()
+        task = db.session.scalar(u.tasks.select())
+
+        from app import export
+        serialize = export._serialize
+        serialized = []
+
+        # worker chết giữa lô thứ 2 ở lần chạy đầu
+        def flaky(row):
+            if row.body == 'post 3' and 'post 3' not in serialized:
+                serialized.append(row.body)
+                raise RuntimeError('worker died')
+            serialized.append(row.body)
+            return serialize(row)
+
+        tasks = self.import_tasks()
+        queue = get_queue('export_posts')
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(tasks, 'app', self.app), \
+                mock.patch.object(export, '_serialize', flaky), \
+                mail.record_messages() as outbox:
+            self.app.artifacts.root = tmp
+            rq.SimpleWorker([queue], connection=queue.connection).work(
+                burst=True)
+            path = self.app.artifacts.get(u.id, task.id)
+            self.assertIsNotNone(path)
+            with gzip.open(path, 'rt') as f:
+                self.assertEqual([json.loads(line)['body'] for line in f],
+                                 [f'post {i}' for i in range(5)])
+        # lần chạy lại tiếp tục từ checkpoint của cùng job
+        self.assertEqual(serialized.count('post 0'), 1)
+        self.assertEqual(serialized.count('post 3'), 2)
+        self.assertEqual(len(outbox), 1)
+        self.assertIn(f'/export_posts/{task.id}', outbox[0].body)
+        db.session.refresh(task)
+        self.assertTrue(task.complete)
+        self.assertEqual(task.get_rq_job().get_status(), 'finished')
+
+    def test_schedule_artifact_cleanup(self):
+        queue = get_queue('cleanup_artifacts')
+        scheduled = queue.scheduled_job_registry
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['artifacts', 'schedule'])
+        self.assertIn('scheduled every 3600s', result.output)
+        # chạy lại lệnh (vd. mỗi lần deploy) không tạo thêm chuỗi job
+        result = runner.invoke(args=['artifacts', 'schedule'])
+        self.assertIn('already scheduled', result.output)
+        self.assertEqual(queue.count, 1)
+
+        # job tự hẹn lại đúng 1 job; chuỗi thừa từ trước thì dừng
+        queue.enqueue('app.tasks.cleanup_artifacts', 3600)
+        tasks = self.import_tasks()
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(tasks, 'app', self.app):
+            self.app.artifacts.root = tmp
+            rq.SimpleWorker([queue], connection=queue.connection).work(
+                burst=True)
+        self.assertEqual(scheduled.get_job_ids(),
+                         [scheduled_job_id('cleanup_artifacts')])
+        result = runner.invoke(args=['artifacts', 'schedule'])
+        self.assertIn('already scheduled', result.output)
+
+    def test_launch_task(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        queue = get_queue('export_posts')
+        lock = f'task-lock:{u.id}:export_posts'
+
+        # request khác đã tạo job nhưng chưa commit task
+        phantom = u.launch_task('export_posts', 'Exporting')
+        db.session.rollback()
+        task = u.launch_task('export_posts', 'Exporting')
+        self.assertEqual(task.id, phantom.id)
+        self.assertNotIn(task, db.session)
+        # job đó lỗi: khoá cũ bị bỏ qua, tạo job mới
+        queue.remove(phantom.id)
+        rq.job.Job.fetch(phantom.id, connection=queue.connection).set_status(
+            rq.job.JobStatus.FAILED)
+        task = u.launch_task('export_posts', 'Exporting')
+        self.assertNotEqual(task.id, phantom.id)
+        db.session.commit()
+
+        # task đang chờ chạy: gọi lại trả về đúng task đó
+        self.assertIs(u.launch_task('export_posts', 'Exporting'), task)
+        self.assertEqual(self.redis.get(lock).decode(), task.id)
+
+        # task chạy xong thì giải phóng khoá
+        tasks = self.import_tasks()
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(tasks, 'app', self.app), \
+                mail.record_messages():
+            self.app.artifacts.root = tmp
+            rq.SimpleWorker([queue], connection=queue.connection).work(
+                burst=True)
+        db.session.refresh(task)
+        self.assertTrue(task.complete)
+        self.assertFalse(self.redis.exists(lock))
+
+        # khoá còn lại của task đã xong (vd. không giải phóng được)
+        self.redis.set(lock, task.id)
+        new_task = u.launch_task('export_posts', 'Exporting')
+        self.assertNotEqual(new_task.id, task.id)
+        self.assertEqual(self.redis.get(lock).decode(), new_task.id)
+        self.assertEqual(queue.count, 1)
+
+    def test_timeline_fanout(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u2)
+        db.session.commit()
+        start = datetime(2024, 1, 1)
+        self.add_posts(u1, 2, start)
+        self.add_posts(u2, 2, start + timedelta(seconds=10))
+        self.add_posts(u3, 2, start + timedelta(seconds=20))
+
+        # lần đọc đầu dựng timeline từ database
+        page = u1.timeline_page(10)
+        self.assertEqual(page.source, 'fanout')
+        self.assertEqual(page.items, self.expected_timeline(u1))
+        key = f'timeline:{u1.id}'
+        self.assertEqual(self.redis.zcard(key), 4)
+
+        # bài mới được fan-out tới người theo dõi
+        post = self.add_posts(u2, 1, start + timedelta(hours=1))[0]
+        self.assertEqual(int(self.redis.zrevrange(key, 0, 0)[0]), post.id)
+        self.assertEqual(u1.timeline_page(10).items,
+                         self.expected_timeline(u1))
+
+        # follow thì bài cũ của người đó được gộp vào
+        u1.follow(u3)
+        db.session.commit()
+        self.assertEqual(self.redis.zcard(key), 7)
+        self.assertEqual(u1.timeline_page(10).items,
+                         self.expected_timeline(u1))
+
+        # unfollow thì timeline bị xoá và dựng lại lúc đọc
+        u1.unfollow(u3)
+        db.session.commit()
+        self.assertEqual(self.redis.exists(key), 0)
+        self.assertEqual(u1.timeline_page(10).items,
+                         self.expected_timeline(u1))
+        self.assertEqual(self.redis.zcard(key), 5)
+
+    def test_timeline_length(self):
+        self.app.config['TIMELINE_LENGTH'] = 4
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.add_posts(u, 10, datetime(2024, 1, 1))
+        expected = self.expected_timeline(u)
+
+        page1 = u.timeline_page(3)
+        self.assertEqual(page1.source, 'fanout')
+        self.assertEqual(page1.items, expected[:3])
+        self.assertEqual(self.redis.zcard(f'timeline:{u.id}'), 4)
+        self.add_posts(u, 1, datetime(2025, 1, 1))
+        self.assertEqual(self.redis.zcard(f'timeline:{u.id}'), 4)
+        expected = self.expected_timeline(u)
+
+        # trang nằm ngoài phần được cache thì đọc từ database
+        page1 = u.timeline_page(3)
+        page2 = u.timeline_page(3, before=page1.next_cursor)
+        self.assertEqual(page2.source, 'sql')
+        self.assertEqual(page2.items, expected[3:6])
+        self.assertEqual(u.timeline_posts(2, 3), None)
+
+    def test_timeline_hybrid(self):
+        self.app.config['TIMELINE_FANOUT_THRESHOLD'] = 1
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        star = User(username='star', email='star@example.com')
+        db.session.add_all([u1, u2, u3, star])
+        u1.follow(star)
+        u2.follow(star)
+        u1.follow(u2)
+        db.session.commit()
+        start = datetime(2024, 1, 1)
+        # bài của star và u2 xen kẽ nhau theo thời gian
+        self.add_posts(star, 5, start)
+        self.add_posts(u2, 5, start + timedelta(seconds=30))
+        self.add_posts(u3, 1, start)
+        self.assertEqual(self.redis.smembers('timeline-celebrities'),
+                         {str(star.id).encode()})
+        expected = self.expected_timeline(u1)
+        self.assertEqual(len(expected), 10)
+
+        # timeline dựng từ database đã có bài của star, danh sách bài của
+        # star cũng có: kết quả trộn không được trùng
+        page1 = u1.timeline_page(4)
+        self.assertEqual(page1.source, 'hybrid')
+        page2 = u1.timeline_page(4, before=page1.next_cursor)
+        page3 = u1.timeline_page(4, before=page2.next_cursor)
+        self.assertEqual(page1.items + page2.items + page3.items, expected)
+        self.assertFalse(page3.has_next)
+        posts, total, source = u1.timeline_posts(2, 4)
+        self.assertEqual((posts, source), (expected[4:8], 'hybrid'))
+
+        # bài mới của star không fan-out nhưng vẫn có trên timeline
+        post = self.add_posts(star, 1, start + timedelta(hours=1))[0]
+        self.assertNotIn(str(post.id).encode(),
+                         self.redis.zrange(f'timeline:{u1.id}', 0, -1))
+        self.assertEqual(u1.timeline_page(4).items[0], post)
+
+        self.app.config['TIMELINE_LENGTH'] = 5
+        self.app.config['POSTS_PER_PAGE'] = 2
+        self.redis.delete(f'timeline:{u1.id}')
+        expected = self.expected_timeline(u1)
+        cursor = encode_cursor(cursor_values(expected[6],
+                                             Post.cursor_columns()))
+        self.app.test_client_class = FlaskLoginClient
+        follower = self.app.test_client(user=u1)
+        loner = self.app.test_client(user=u3)
+        # mỗi request tự tạo app context riêng như khi chạy thật
+        self.app_context.pop()
+        try:
+            self.assertEqual(loner.get('/index').headers['X-Timeline-Source'],
+                             'fanout')
+            response = follower.get('/index')
+            self.assertEqual(response.headers['X-Timeline-Source'], 'hybrid')
+            # trang nằm ngoài phần được cache
+            response = follower.get(f'/index?before={cursor}')
+            self.assertEqual(response.headers['X-Timeline-Source'], 'sql')
+        finally:
+            self.app_context.push()
+
+    def test_timeline_follow_celebrity(self):
+        self.app.config['TIMELINE_FANOUT_THRESHOLD'] = 1
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        star = User(username='star', email='star@example.com')
+        db.session.add_all([u1, u2, u3, star])
+        db.session.commit()
+        start = datetime(2024, 1, 1)
+        self.add_posts(star, 3, start)
+        u2.follow(star)
+        u3.follow(star)
+        db.session.commit()
+        # bài đầu tiên sau khi vượt ngưỡng: danh sách lấy cả các bài cũ
+        self.add_posts(star, 1, start + timedelta(hours=1))
+        self.add_posts(u1, 1, start + timedelta(hours=2))
+        self.assertEqual(self.redis.zcard(f'timeline-author:{star.id}'), 4)
+        self.assertEqual(len(u1.timeline_page(10).items), 1)
+
+        u1.follow(star)
+        db.session.commit()
+        expected = self.expected_timeline(u1)
+        self.assertEqual(len(expected), 5)
+        page = u1.timeline_page(10)
+        self.assertEqual(page.source, 'hybrid')
+        self.assertEqual(page.items, expected)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file